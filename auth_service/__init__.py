@@ -6,4 +6,7 @@ def create_auth():
     from auth_service.routes import main2
     app.register_blueprint(main2) 
 
+    from auth_service import metrics
+    metrics.init_app(app)
+
     return app
\ No newline at end of file
@@ -1,10 +1,22 @@
 from auth_service import create_auth
+import logging
 import os
 
+# "dev" runs the flask development server, "prod" the pre-fork gunicorn server
+SERVER_MODE = os.getenv("SERVER_MODE", "dev").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
 app = create_auth()
 
 if __name__ == "__main__":
+    # background threads (the metrics writer) report failures through logging
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
     app.config.from_prefixed_env()
     host = "0.0.0.0" 
     port = int(os.getenv("AUTH_SERVICE_PORT", 8001))
-    app.run(host=host, port=port, debug=True)
\ No newline at end of file
+    if SERVER_MODE == "prod":
+        from auth_service.server import ProductionServer
+        from auth_service.database import close_db_connections
+        ProductionServer(app, f"{host}:{port}", on_ready=close_db_connections).run()
+    else:
+        app.run(host=host, port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,27 @@
+import threading
+import os
+
+class ProcessThread:
+    """Daemon thread that is started on first use, once per process. threads do not survive a fork, so a forked
+        worker starts its own copy the first time it calls ensure_started(). on_start runs right before the thread
+        is started, e.g. to drop state a forked process inherited from its parent"""
+
+    def __init__(self, target, name, on_start=None):
+        self.target = target
+        self.name = name
+        self.on_start = on_start
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        """Start the thread unless this process already did."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.on_start is not None:
+                self.on_start()
+            threading.Thread(target=self.target, name=self.name, daemon=True).start()
+            # set last, so other threads wait for on_start instead of using state it is about to reset
+            self._pid = os.getpid()
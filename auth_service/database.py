@@ -1,17 +1,79 @@
 import sqlite3
+import queue
+import hmac
+import time
 import os
+from auth_service.metrics import TimedConnection
  
 DB_MOUNT_POINT = os.getenv("DB_MOUNT_POINT", "/var/data")
 DB_NAME = os.getenv("DB_NAME_AUTH", "users.db")
 DATABASE_URL = f"sqlite:///{DB_MOUNT_POINT}/{DB_NAME}"
 
-def __get_db_connection():
-    """Establish a connection to the database."""
+# connection pool & pragma settings, shared with the URL shortener's database settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+REVOCATION_FEED_MAX_ROWS = 10000  # revocations per feed response
+REVOCATION_CHECK_CHUNK = 400  # tokens per revocation query, keeps it below SQLite's 999 parameter limit
+LIST_CHUNK_SIZE = int(os.getenv("LIST_CHUNK_SIZE", 1000))  # rows fetched per step when streaming listings
+USER_FIELDS = ("id", "username", "password", "token")  # fields a user listing can select, id is the rowid
+
+__pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+class PooledConnection(TimedConnection):
+    """sqlite3 connection that is kept open between requests. close() hands it back to the pool"""
+    pooled = False
+
+    def close(self):
+        release_db_connection(self)
+
+def __open_db_connection():
+    """Open a new connection and apply the configured pragmas (done once per pooled connection)."""
     db_path = DATABASE_URL.replace("sqlite:///", "")
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row    
+    conn = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           factory=PooledConnection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
     return conn
 
+def __get_db_connection():
+    """Take an idle connection from the pool, opening a new one if none is available."""
+    try:
+        conn = __pool.get_nowait()
+    except queue.Empty:
+        conn = __open_db_connection()
+    conn.pooled = False
+    return conn
+
+def release_db_connection(conn):
+    """Return a connection to the pool. Open transactions are rolled back, connections beyond
+        DB_POOL_SIZE are closed for real"""
+    if conn.pooled:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    conn.pooled = True
+    try:
+        __pool.put_nowait(conn)
+    except queue.Full:
+        sqlite3.Connection.close(conn)
+
+def close_db_connections():
+    """Close all idle pooled connections, e.g. in a pre-fork master before its workers are forked."""
+    while True:
+        try:
+            conn = __pool.get_nowait()
+        except queue.Empty:
+            break
+        sqlite3.Connection.close(conn)
+
+def __password_matches(stored, given):
+    """Constant-time comparison, the time taken does not reveal how much of the password matched."""
+    return hmac.compare_digest(stored.encode("utf-8"), given.encode("utf-8"))
+
 def create_table():
     """Create the table if it does not exist."""
     conn = __get_db_connection()
@@ -25,75 +87,199 @@ def create_table():
     )
     """)
 
+    # revoked tokens (jti) and revoked users (every token issued before not_before), kept until expires_at, when
+    # all the tokens they affect have expired. version is the position in the revocation feed
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS token_revocations (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        jti TEXT,
+        username TEXT,
+        not_before REAL,
+        expires_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS token_revocations_jti ON token_revocations (jti)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS token_revocations_username ON token_revocations (username)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS token_revocations_expires_at ON token_revocations (expires_at)")
+
     conn.commit()
     conn.close()
 
 # Username - password section
 def create_user_mapping(username, password):
     """Create a new user. Returns True if successful, False if username already exists."""
+    conn = __get_db_connection()
     try:
-        conn = __get_db_connection()
         cursor = conn.cursor()
         cursor.execute("INSERT INTO user_mappings (username, password) VALUES (?, ?)", (username, password))
         conn.commit()
-        conn.close()
         return True  
     except sqlite3.IntegrityError:
         return False  
+    finally:
+        conn.close()
     
 def check_user_exists(username):
+    conn = __get_db_connection()
     try:
-        conn = __get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT username FROM user_mappings WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        return True if result else False  
-    except sqlite3.IntegrityError:
-        return False  
-
+        cursor.execute("SELECT 1 FROM user_mappings WHERE username = ?", (username,))
+        return cursor.fetchone() is not None
+    finally:
+        conn.close()
 
 def authenticate_user(username, password):
-    """Attempt to access the user with username and password."""
+    """Check the password of the user, looked up by the unique username index."""
+    conn = __get_db_connection()
     try:
-        conn = __get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT ? FROM user_mappings WHERE password = ?", (username, password))
+        cursor.execute("SELECT password FROM user_mappings WHERE username = ?", (username,))
         result = cursor.fetchone()
+        return result is not None and __password_matches(result["password"], password)
+    finally:
+        conn.close()
+
+def login_user(username, password, issue_token):
+    """Check the credentials and store a new token in one transaction on one connection. issue_token(username)
+        is only called for matching credentials. Returns the token, or None if the user does not exist or the
+        password is wrong"""
+    conn = __get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # take the write lock up front, a read transaction could not be upgraded once another login committed
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT rowid, password FROM user_mappings WHERE username = ?", (username,))
+        result = cursor.fetchone()
+        if result is None or not __password_matches(result["password"], password):
+            return None
+        token = issue_token(username)
+        cursor.execute("UPDATE user_mappings SET token = ? WHERE rowid = ?", (token, result["rowid"]))
+        conn.commit()
+        return token
+    finally:
         conn.close()
-        return True if result else False  
-    except sqlite3.IntegrityError:
-        return False  
     
-def update_user_mapping(username, new_password):
-    """Update an existing user's password mapping."""
+def update_user_mapping(username, new_password, tokens_expire_at):
+    """Update an existing user's password mapping and revoke the tokens issued before, in one transaction.
+        tokens_expire_at is when the last of those tokens expires"""
     conn = __get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE user_mappings SET password = ? WHERE username = ?", (new_password, username))
-    conn.commit()
-    updated_rows = cursor.rowcount 
-    conn.close()
-    return updated_rows > 0  
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE user_mappings SET password = ? WHERE username = ?", (new_password, username))
+        if cursor.rowcount == 0:
+            return False
+        __insert_revocation(cursor, None, username, time.time(), tokens_expire_at)
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+def revoke_token(jti, expires_at):
+    """Revoke one token (e.g. on logout) until it expires."""
+    conn = __get_db_connection()
+    try:
+        __insert_revocation(conn.cursor(), jti, None, None, expires_at)
+        conn.commit()
+    finally:
+        conn.close()
+
+def __insert_revocation(cursor, jti, username, not_before, expires_at):
+    # revocations of expired tokens are dropped, expired tokens are rejected anyway
+    cursor.execute("DELETE FROM token_revocations WHERE expires_at <= ?", (time.time(),))
+    cursor.execute("INSERT INTO token_revocations (jti, username, not_before, expires_at) VALUES (?, ?, ?, ?)",
+                   (jti, username, not_before, expires_at))
+
+def is_token_revoked(claims):
+    """True if the token's jti was revoked, or its user's tokens were revoked after it was issued."""
+    return bool(revoked_tokens([claims]))
+
+def revoked_tokens(claims_list):
+    """Indexes of the tokens in claims_list that are revoked (see is_token_revoked). one query on one connection
+        looks up the revoked jtis and the latest not_before of each user, for REVOCATION_CHECK_CHUNK tokens at a time"""
+    if not claims_list:
+        return set()
+    revoked_jtis, not_before = set(), {}
+    conn = __get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # one read snapshot for all chunks
+        cursor.execute("BEGIN")
+        now = time.time()
+        for start in range(0, len(claims_list), REVOCATION_CHECK_CHUNK):
+            chunk = claims_list[start:start + REVOCATION_CHECK_CHUNK]
+            jtis = list({claims.get("jti") for claims in chunk if claims.get("jti")})
+            users = list({claims.get("name") for claims in chunk if claims.get("name")})
+            cursor.execute(f"SELECT jti, NULL AS username, NULL AS not_before FROM token_revocations "
+                           f"WHERE expires_at > ? AND jti IN ({', '.join('?' * len(jtis))}) "
+                           f"UNION ALL "
+                           f"SELECT NULL, username, MAX(not_before) FROM token_revocations "
+                           f"WHERE expires_at > ? AND username IN ({', '.join('?' * len(users))}) "
+                           f"AND not_before IS NOT NULL GROUP BY username",
+                           [now, *jtis, now, *users])
+            for row in cursor.fetchall():
+                if row["jti"] is not None:
+                    revoked_jtis.add(row["jti"])
+                else:
+                    not_before[row["username"]] = row["not_before"]
+        conn.commit()
+    finally:
+        conn.close()
+    return {i for i, claims in enumerate(claims_list)
+            if claims.get("jti") in revoked_jtis or (claims.get("iat") or 0) < not_before.get(claims.get("name"), 0)}
+
+def revocations_since(version, limit=REVOCATION_FEED_MAX_ROWS):
+    """Return (feed version, revocations after `version` that have not expired, more). the feed version is the
+        latest revocation's version, or the last one returned while `more` are left"""
+    conn = __get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # one read snapshot for the rows and the sequence, a revocation committed in between would otherwise be
+        # counted in the feed version without being returned, and pollers would skip it for good
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT version, jti, username, not_before, expires_at FROM token_revocations "
+                       "WHERE version > ? AND expires_at > ? ORDER BY version LIMIT ?", (version, time.time(), limit + 1))
+        rows = cursor.fetchall()
+        if len(rows) > limit:
+            return rows[limit - 1]["version"], rows[:limit], True
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'token_revocations'")
+        result = cursor.fetchone()
+        conn.commit()
+        return max(version, result["seq"] if result else 0), rows, False
+    finally:
+        conn.close()
 
 def update_token(token, username):
-    """Update an existing user's password mapping."""
+    """Store the latest token of a user."""
     conn = __get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE user_mappings SET token = ? WHERE username = ?", (token, username))
-    print(token)
-    conn.commit()
-    updated_rows = cursor.rowcount 
-    conn.close()
-    return True
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE user_mappings SET token = ? WHERE username = ?", (token, username))
+        conn.commit()
+        return True
+    finally:
+        conn.close()
 
-def get_users():
-    """Retrieve all user mappings and their subvalues."""
+def iter_user_chunks(fields, after=0, limit=None, chunk_size=LIST_CHUNK_SIZE):
+    """Yield lists of (cursor, user) straight from the database cursor, chunk_size rows at a time, for the users
+        with a rowid > after. user is a dict of the selected fields (a subset of USER_FIELDS), cursor the rowid to
+        continue after. the connection is held until the generator is exhausted or closed"""
+    columns = "".join(", rowid AS id" if field == "id" else f", {field}" for field in fields if field in USER_FIELDS)
+    query = f"SELECT rowid AS cursor{columns} FROM user_mappings WHERE rowid > ? ORDER BY rowid"
+    params = (after,)
+    if limit is not None:
+        query += " LIMIT ?"
+        params += (limit,)
     conn = __get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT username, password, token FROM user_mappings")
-    rows = cursor.fetchall()
-    conn.commit()
-    conn.close()
-    return rows
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [(row["cursor"], {field: row[field] for field in fields}) for row in rows]
+    finally:
+        conn.close()
 
 create_table()
 
@@ -0,0 +1,375 @@
+import logging
+import threading
+import weakref
+import sqlite3
+import bisect
+import contextlib
+import fcntl
+import json
+import glob
+import time
+import os
+from flask import Response, g, request
+from .background import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# directory the worker processes of the pre-fork server share their metrics through, a temporary one if unset
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", 5.0))  # seconds between writes of a worker's file
+
+class _ThreadShards:
+    """Per-thread value dicts. each thread only writes to its own dict, so recording takes no lock; the dicts
+        are merged when metrics are scraped. dicts of finished threads are folded into one retired dict"""
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self.__sweep()
+                self._shards.append((weakref.ref(threading.current_thread()), values))
+            return values
+
+    def collect(self):
+        with self._lock:
+            self.__sweep()
+            total = {}
+            for values in [self._retired] + [values for _, values in self._shards]:
+                for key, value in list(values.items()):
+                    self._merge(total, key, value)
+            return total
+
+    def __sweep(self):
+        alive = []
+        for thread_ref, values in self._shards:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                for key, value in list(values.items()):
+                    self._merge(self._retired, key, value)
+            else:
+                alive.append((thread_ref, values))
+        self._shards = alive
+
+def _merge_number(total, key, value):
+    total[key] = total.get(key, 0) + value
+
+def _merge_list(total, key, value):
+    if key in total:
+        total[key] = [a + b for a, b in zip(total[key], value)]
+    else:
+        total[key] = list(value)
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._shards = _ThreadShards(_merge_number)
+
+    def inc(self, labels=(), amount=1):
+        values = self._shards.values()
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, list(zip(self.labelnames, labels)), value)
+                for labels, value in sorted(self._shards.collect().items())]
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._shards = _ThreadShards(_merge_list)
+
+    def observe(self, value, labels=()):
+        values = self._shards.values()
+        # [count per bucket..., count above last bucket, sum]
+        series = values.get(labels)
+        if series is None:
+            series = values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        samples = []
+        for labels, series in sorted(self._shards.collect().items()):
+            pairs = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", pairs + [("le", _format_value(bound))], cumulative))
+            samples.append((f"{self.name}_sum", pairs, series[-1]))
+            samples.append((f"{self.name}_count", pairs, cumulative))
+        return samples
+
+class MultiProcessStore:
+    """Metrics of all worker processes of a pre-fork server, one JSON file per process in `directory`. every
+        worker rewrites its file with families_fn() every write_interval seconds, when it is scraped and when it exits, and a scrape
+        merges all files. counters and histograms are summed, including those of exited workers, which the master
+        folds into an archive file so totals never go down. gauges are reported per live worker, with a 'pid' label"""
+
+    ARCHIVE = "archive.json"
+
+    def __init__(self, directory, families_fn, write_interval=METRICS_WRITE_INTERVAL):
+        self.directory = directory
+        self.families_fn = families_fn
+        self.write_interval = write_interval
+        self._write_lock = threading.Lock()
+        self._writer = ProcessThread(self.__run, "metrics-writer")
+
+    def reset(self):
+        """Drop the files of an earlier run, called in the master before any worker is forked."""
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            os.remove(path)
+
+    def write(self, families):
+        """Replace this process's file atomically, a scrape reads either the old or the new one."""
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with self._write_lock:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(families, f)
+            os.replace(f"{path}.tmp", path)
+
+    def merge(self, families):
+        """Write this process's families, then return the merged families of all processes."""
+        self.write(families)
+        merged = {}
+        with self.__locked(fcntl.LOCK_SH):
+            for path in sorted(glob.glob(os.path.join(self.directory, "*.json"))):
+                try:
+                    with open(path) as f:
+                        process_families = json.load(f)
+                except FileNotFoundError:
+                    continue  # exited worker that was archived meanwhile
+                pid = os.path.basename(path)[:-len(".json")]
+                self.__add(merged, process_families, None if pid == "archive" else pid)
+        return [(name, type, help, [(sample_name, list(pairs), value) for (sample_name, pairs), value in samples.items()])
+                for name, (type, help, samples) in merged.items()]
+
+    def archive(self, pid):
+        """Fold the counters and histograms of an exited worker into the archive and remove its file."""
+        path = os.path.join(self.directory, f"{pid}.json")
+        archive_path = os.path.join(self.directory, self.ARCHIVE)
+        with self.__locked(fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                return
+            merged = {}
+            for file_path in (archive_path, path):
+                if os.path.exists(file_path):
+                    with open(file_path) as f:
+                        self.__add(merged, json.load(f), None)
+            families = [(name, type, help, [(sample_name, list(pairs), value)
+                                            for (sample_name, pairs), value in samples.items()])
+                        for name, (type, help, samples) in merged.items() if type != "gauge"]
+            with open(f"{archive_path}.tmp", "w") as f:
+                json.dump(families, f)
+            os.replace(f"{archive_path}.tmp", archive_path)
+            os.remove(path)
+
+    def ensure_writer(self):
+        """Start the background write thread of this process."""
+        self._writer.ensure_started()
+
+    def __run(self):
+        while True:
+            time.sleep(self.write_interval)
+            try:
+                self.write(self.families_fn())
+            except Exception:
+                logger.exception("metrics write failed, retrying later")
+
+    @contextlib.contextmanager
+    def __locked(self, operation):
+        """Scrapes read under a shared lock, the master archives under an exclusive one (released on close)."""
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, operation)
+            yield
+
+    @staticmethod
+    def __add(merged, families, pid):
+        for name, type, help, samples in families:
+            family = merged.setdefault(name, (type, help, {}))
+            for sample_name, pairs, value in samples:
+                pairs = tuple(tuple(pair) for pair in pairs)
+                if type == "gauge":
+                    if pid is None:
+                        continue
+                    pairs += (("pid", pid),)
+                key = (sample_name, pairs)
+                family[2][key] = family[2].get(key, 0) + value
+
+class Registry:
+    """Metrics of this process, or of all worker processes once enable_multiprocess() was called. collectors are
+        callables returning (name, type, help, [(labels, value)]) tuples for values that are read at scrape time
+        (cache sizes, breaker state, ...)"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._store = None
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def enable_multiprocess(self, directory):
+        """Share metrics through `directory` (emptied here), called in a pre-fork master before forking."""
+        self._store = MultiProcessStore(directory, self.families)
+        self._store.reset()
+
+    def ensure_writer(self):
+        """In multiprocess mode, make sure this process writes its metrics regularly."""
+        if self._store is not None:
+            self._store.ensure_writer()
+
+    def write_process_metrics(self):
+        """Write this process's metrics one last time, e.g. when a worker exits."""
+        if self._store is not None:
+            self._store.write(self.families())
+
+    def archive_process(self, pid):
+        """Keep the counters of an exited worker, called in the master."""
+        if self._store is not None:
+            self._store.archive(pid)
+
+    def families(self):
+        """This process's metrics as (name, type, help, [(sample name, [(label, value)], value)]) tuples."""
+        families = []
+        for metric in self._metrics:
+            families.append((metric.name, "counter" if isinstance(metric, Counter) else "histogram", metric.help,
+                             metric.samples()))
+        for collector in self._collectors:
+            for name, type, help, samples in collector():
+                families.append((name, type, help, [(name, sorted(labels.items()), value) for labels, value in samples]))
+        return families
+
+    def render(self):
+        """Prometheus text exposition format."""
+        families = self.families()
+        if self._store is not None:
+            families = self._store.merge(families)
+        lines = []
+        for name, type, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for sample_name, pairs, value in samples:
+                lines.append(f"{sample_name}{_format_labels(pairs)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests handled", ("method", "route", "status"))
+http_request_duration = registry.histogram("http_request_duration_seconds", "Time spent in the route handler",
+                                           ("method", "route"))
+db_query_duration = registry.histogram("db_query_duration_seconds", "SQLite statement and commit time, including "
+                                       "time spent waiting for locks (busy_timeout)", ("operation",))
+db_locked_errors = registry.counter("db_locked_errors_total", "Statements that failed with 'database is locked'",
+                                    ("operation",))
+
+def gauge(name, help, samples):
+    """Helper for collectors: a gauge with the given [(labels, value)] samples."""
+    return (name, "gauge", help, samples)
+
+def stats_collector(prefix, description, stats_fn, counters=()):
+    """Collector exposing a stats() dict: keys listed in counters become {prefix}_{key}_total counters,
+        all other numeric values gauges"""
+    def collect():
+        result = []
+        for key, value in stats_fn().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key in counters:
+                result.append((f"{prefix}_{key}_total", "counter", f"{description}: {key}", [({}, value)]))
+            else:
+                result.append(gauge(f"{prefix}_{key}", f"{description}: {key}", [({}, value)]))
+        return result
+    return collect
+
+def __before_request():
+    registry.ensure_writer()
+    g.metrics_start = time.perf_counter()
+
+def __after_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        http_request_duration.observe(time.perf_counter() - start, (request.method, route))
+        http_requests.inc((request.method, route, str(response.status_code)))
+    return response
+
+def init_app(app):
+    """Record per-route request counts and latency and serve them (with all other metrics) at /metrics."""
+    app.before_request(__before_request)
+    app.after_request(__after_request)
+    app.add_url_rule("/metrics", "metrics", lambda: Response(registry.render(), mimetype="text/plain; version=0.0.4"))
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording the duration of every statement and 'database is locked' failures."""
+
+    def execute(self, sql, parameters=()):
+        return _timed(sql, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return _timed(sql, super().executemany, sql, seq_of_parameters)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors and commits are timed."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return _timed("COMMIT", super().commit)
+
+def _timed(sql, fn, *args):
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "OTHER"
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            db_locked_errors.inc((operation,))
+        raise
+    finally:
+        db_query_duration.observe(time.perf_counter() - start, (operation,))
@@ -1,33 +1,70 @@
-from flask import Blueprint, jsonify, request, redirect, url_for
+from flask import Blueprint, jsonify, request, redirect, url_for, Response
 from werkzeug.exceptions import HTTPException
 from auth_service.database import (
     create_user_mapping, check_user_exists, authenticate_user, 
-    update_user_mapping, get_users,
-    update_token
+    update_user_mapping, iter_user_chunks, USER_FIELDS,
+    login_user, revoke_token, is_token_revoked, revoked_tokens, revocations_since
 )
-from auth_service.utils import (generate_jwt, verify_jwt)
+from auth_service.utils import (generate_jwt, verify_jwt_claims, JWT_TTL_SECONDS)
+import itertools
+import json
+import time
+import os
 
 ERROR_MAPPING_EXISTS = "Mapping for the provided URL: {url} already exists"
+TOKENS_VERIFY_MAX_BATCH = int(os.getenv("TOKENS_VERIFY_MAX_BATCH", 1000))
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", 1000))
+USER_DEFAULT_FIELDS = ("username",)
 
 main2 = Blueprint('main', __name__)
 
+def __check_token(token):
+    """Signature, expiry and revocation check of a token. returns (claims, None) or (None, reason)"""
+    claims, error = verify_jwt_claims(token)
+    if error is None and is_token_revoked(claims):
+        return None, "token revoked"
+    return claims, error
+
 # Username - password section
 @main2.route('/users', methods=['GET'])
 def get_all_users():
-    """Retrieves all stored short URLs (IDs only)."""
-    success = get_users()
-    string = ""
-    if success:
-        for row in success:
-            string += ("--------------------\n")
-            string += (f"Username: {row['username']}\n")
-            string += (f"Password: {row['password']}\n")
-            string += (f"Token:    {row['token']}\n")
-        string += ("--------------------")
-    if not success:
+    """Retrieves the users with the fields given in ?fields= (username by default, the password only if asked for).
+       ?limit=&after= returns one page plus the cursor of the next page, otherwise the whole listing is streamed
+       from the database cursor as JSON, or as NDJSON with ?format=ndjson"""
+    fields = tuple(field for field in request.args.get("fields", ",".join(USER_DEFAULT_FIELDS)).split(",") if field)
+    unknown = [field for field in fields if field not in USER_FIELDS]
+    if unknown or not fields:
+        return jsonify({"error": f"Unknown fields {unknown}, choose from {list(USER_FIELDS)}"}), 400
+    after = request.args.get("after", 0, type=int)
+    limit = request.args.get("limit", type=int)
+
+    if limit is not None:
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        rows = next(iter_user_chunks(fields, after, limit + 1, limit + 1), [])
+        if not rows and after == 0:
+            return jsonify({"error": "No User found"}), 404
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return jsonify({"users": [user for _, user in rows[:limit]], "next": next_cursor}), 200
+
+    chunks = iter_user_chunks(fields, after)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
         return jsonify({"error": "No User found"}), 404  
 
-    return string, 200
+    if request.args.get("format") == "ndjson":
+        def generate_ndjson():
+            for chunk in itertools.chain([first_chunk], chunks):
+                yield "".join(json.dumps(user) + "\n" for _, user in chunk)
+        return Response(generate_ndjson(), mimetype="application/x-ndjson"), 200
+
+    def generate_json():
+        yield '{"users": ['
+        separator = ""
+        for chunk in itertools.chain([first_chunk], chunks):
+            yield separator + ",".join(json.dumps(user) for _, user in chunk)
+            separator = ","
+        yield "]}"
+    return Response(generate_json(), mimetype="application/json"), 200
 
 @main2.route('/users', methods=['POST'])
 def create_user():
@@ -62,23 +99,16 @@ def user_login():
             return jsonify({"error": "Missing 'username' and 'password', or 'token' field"}), 400
 
         if username and password and not existing_token:
-            if check_user_exists(username) is False:
-                return jsonify({"error": "Your username and password did not match an existing combination in our system"}), 403
-            
-            if authenticate_user(username, password) is False:
-                return jsonify({"error": "Your username and password did not match an existing combination in our system"}), 403
+            # one indexed lookup, password check and token write in a single transaction
+            generated_token = login_user(username, password, generate_jwt)
 
-            generated_token = generate_jwt(username)
-            success = update_token(generated_token, username)
-
-            if not success:
-                return jsonify({"error": "Something went wrong."}), 400
-            else:
-                return jsonify({"token": generated_token}), 201  
+            if generated_token is None:
+                return jsonify({"error": "Your username and password did not match an existing combination in our system"}), 403
+            return jsonify({"token": generated_token}), 201  
 
         if existing_token:
             
-            success = verify_jwt(existing_token)
+            success, _ = __check_token(existing_token)
 
             if not success:
                 return jsonify({"error": "The signature verification failed for your token."}), 400
@@ -108,11 +138,69 @@ def update_password():
         if authenticate_user(username, old_password) is False:
             return jsonify({"error": "Password is incorrect, please try again"}), 403
 
-        success = update_user_mapping(username, new_password)
+        # tokens issued before the change are revoked, they expire within JWT_TTL_SECONDS
+        success = update_user_mapping(username, new_password, time.time() + JWT_TTL_SECONDS)
         
         if not success:
             return jsonify({"error": "An unexpected error occurred, please give another new password"}), 404
 
         return jsonify({"username": username, "message": "Password updated successfully"}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 400 
\ No newline at end of file
+        return jsonify({"error": str(e)}), 400 
+
+@main2.route('/tokens/verify', methods=['POST'])
+def verify_tokens():
+    """Verifies many tokens in one call. the body is {"tokens": [...]} or a JSON array of tokens, the answer has
+       one {"valid": ..., "claims": ...} (or "error") per token, in input order."""
+    input_json = request.get_json(force=True, silent=True)
+    tokens = input_json.get("tokens") if isinstance(input_json, dict) else input_json
+    if not isinstance(tokens, list):
+        return jsonify({"error": "Expected a JSON array of tokens or {\"tokens\": [...]}"}), 400
+    if len(tokens) > TOKENS_VERIFY_MAX_BATCH:
+        return jsonify({"error": f"Batch exceeds the maximum of {TOKENS_VERIFY_MAX_BATCH} tokens"}), 413
+
+    # signatures and expiry first, then the revocations of all valid tokens with one query
+    checked = [verify_jwt_claims(token) for token in tokens]
+    valid = [i for i, (_, error) in enumerate(checked) if error is None]
+    revoked = {valid[i] for i in revoked_tokens([checked[i][0] for i in valid])}
+    results = []
+    for i, (claims, error) in enumerate(checked):
+        if i in revoked:
+            error = "token revoked"
+        results.append({"valid": True, "claims": claims} if error is None else {"valid": False, "error": error})
+    return jsonify({"results": results}), 200
+
+@main2.route('/users/logout', methods=['POST'])
+def user_logout():
+    """Revokes the token given in the body ('token') or the Authorization header."""
+    input_json = request.get_json(force=True, silent=True)
+    token = (input_json.get("token") if isinstance(input_json, dict) else None) or request.headers.get("Authorization")
+    if not token:
+        return jsonify({"error": "Missing 'token' field"}), 400
+    claims, error = __check_token(token)
+    if error is not None:
+        return jsonify({"error": f"The token could not be verified: {error}"}), 400
+    if not claims.get("jti"):
+        return jsonify({"error": "The token has no 'jti' and can't be revoked"}), 400
+    revoke_token(claims["jti"], claims["exp"])
+    return jsonify({"message": "The token has been revoked"}), 200
+
+@main2.route('/tokens/revocations', methods=['GET'])
+def get_revocations():
+    """Revocation feed for services that verify tokens locally. ?since=<version> returns the revocations after that
+       version which still affect unexpired tokens: {"jti", "expires_at"} for a single token, {"user", "not_before",
+       "expires_at"} for all tokens of a user issued before not_before. poll again with since=<version>, at once
+       while "more" is true"""
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "'since' must be a version number"}), 400
+    version, rows, more = revocations_since(since)
+    revocations = []
+    for row in rows:
+        if row["jti"] is not None:
+            revocations.append({"version": row["version"], "jti": row["jti"], "expires_at": row["expires_at"]})
+        else:
+            revocations.append({"version": row["version"], "user": row["username"], "not_before": row["not_before"],
+                                "expires_at": row["expires_at"]})
+    return jsonify({"version": version, "revocations": revocations, "more": more}), 200
@@ -0,0 +1,57 @@
+import multiprocessing
+import tempfile
+import shutil
+import os
+
+from gunicorn.app.base import BaseApplication
+from auth_service.metrics import registry, METRICS_MULTIPROC_DIR
+
+# production (pre-fork) server settings
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+WEB_THREADS = int(os.getenv("WEB_THREADS", 4))
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", 10000))  # recycle a worker after N requests, 0 disables
+WEB_MAX_REQUESTS_JITTER = int(os.getenv("WEB_MAX_REQUESTS_JITTER", 1000))
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", 30))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 25))  # drain time after SIGTERM
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", 5))
+
+class ProductionServer(BaseApplication):
+    """Gunicorn pre-fork server for an already created (preloaded) WSGI app. the app and the database schema are
+        set up once in the master, workers are forked from it. workers share their metrics through
+        METRICS_MULTIPROC_DIR, so /metrics reports all of them whichever worker answers"""
+
+    def __init__(self, app, bind, on_ready=None):
+        self.application = app
+        self.bind = bind
+        self.on_ready = on_ready
+        super().__init__()
+
+    def load_config(self):
+        settings = {
+            "bind": self.bind,
+            "workers": WEB_WORKERS,
+            "threads": WEB_THREADS,
+            "worker_class": "gthread",
+            "preload_app": True,
+            "max_requests": WEB_MAX_REQUESTS,
+            "max_requests_jitter": WEB_MAX_REQUESTS_JITTER,
+            "timeout": WEB_TIMEOUT,
+            "graceful_timeout": WEB_GRACEFUL_TIMEOUT,
+            "keepalive": WEB_KEEPALIVE,
+            "accesslog": "-",
+        }
+        metrics_dir = METRICS_MULTIPROC_DIR or tempfile.mkdtemp(prefix="metrics-")
+        registry.enable_multiprocess(metrics_dir)
+        if not METRICS_MULTIPROC_DIR:
+            settings["on_exit"] = lambda arbiter: shutil.rmtree(metrics_dir, ignore_errors=True)
+        # a worker writes its final values on its way out, the master keeps its counters once it is gone
+        settings["worker_exit"] = lambda arbiter, worker: registry.write_process_metrics()
+        settings["child_exit"] = lambda arbiter, worker: registry.archive_process(worker.pid)
+        if self.on_ready:
+            # runs in the master after preloading and before the first worker is forked
+            settings["when_ready"] = lambda arbiter: self.on_ready()
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
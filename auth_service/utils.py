@@ -1,7 +1,9 @@
 import hashlib
 import hmac
+import secrets
 import base64
 import json
+import time
 import os
 
 from dotenv import load_dotenv
@@ -12,11 +14,17 @@ load_dotenv()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 if not SECRET_KEY:
     raise ValueError("JWT_SECRET_KEY environment variable is not set")
+# keyed HMAC state, copied per message instead of hashing the key again each time
+HMAC_KEYED = hmac.new(SECRET_KEY.encode('utf-8'), digestmod=hashlib.sha256)
+# lifetime of issued tokens, also how long revocations of a user's tokens are kept
+JWT_TTL_SECONDS = int(os.getenv("JWT_TTL_SECONDS", 3600))
 
 def hmac_sha256(message):
     # used https://nutbutterfly.medium.com/how-to-sign-your-message-with-hmac-sha256-in-python-and-java-e7d8d055087e as a reference
     """Encodes a message and secret into a hmac_sha256 string."""
-    return hmac.new(SECRET_KEY.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).digest()
+    mac = HMAC_KEYED.copy()
+    mac.update(message.encode('utf-8'))
+    return mac.digest()
 
 def base64_encode(byte_input):
     # used https://www.geeksforgeeks.org/base64-urlsafe_b64encodes-in-python/ as reference
@@ -31,10 +39,18 @@ def construct_jwt(header, payload):
     return jwt
 
 def generate_jwt(username):
+    """Issues a token that expires after JWT_TTL_SECONDS. iat has millisecond precision so a login right after a
+        password change is not caught by the revocation of the older tokens, jti identifies the token for a logout"""
+    issued_at = round(time.time(), 3)
     header = json.dumps({"alg": "HS256", "typ": "JWT"})
-    payload = json.dumps({"sub": "auth", "name": username, "admin": True})
+    payload = json.dumps({"sub": "auth", "name": username, "admin": True, "iat": issued_at,
+                          "exp": int(issued_at) + JWT_TTL_SECONDS, "jti": secrets.token_urlsafe(12)})
     return construct_jwt(header,payload)
 
+def b64url_decode(segment):
+    """Decodes an unpadded base64url JWT segment."""
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
 def add_padding(str):
     if (len(str) % 4 != 0):
         padding_needed = 4 - (len(str) % 4)
@@ -42,18 +58,31 @@ def add_padding(str):
     return str
 
 def verify_jwt(token):
-    token_parts = token.split('.')
-    encoded_header, encoded_payload, encoded_signature = token_parts
-    
-    header_bytes = base64.urlsafe_b64decode(add_padding(encoded_header))
-    payload_bytes = base64.urlsafe_b64decode(add_padding(encoded_payload))
-
-    header = header_bytes.decode('utf-8')
-    payload = payload_bytes.decode('utf-8')
-
-    verification_token = construct_jwt(header, payload)
-    verification_parts = verification_token.split('.')
-    verify_header, verify_payload, verify_signature = verification_parts
+    """Checks the signature over the token's own 'header.payload', no decoding and re-encoding of the parts needed."""
+    encoded_header, encoded_payload, encoded_signature = token.split('.')
+    expected_signature = base64_encode(hmac_sha256(encoded_header + '.' + encoded_payload))
+    return hmac.compare_digest(expected_signature.encode('utf-8'), encoded_signature.encode('utf-8'))
 
-    if(verify_signature == encoded_signature): return True
-    else: return False
\ No newline at end of file
+def verify_jwt_claims(token):
+    """Verifies a token like verify_jwt and decodes its payload, the payload is only decoded once the signature
+        matched. tokens without exp (issued before tokens expired) count as expired. revocations are not checked
+        here. returns (claims, None) or (None, reason)"""
+    if not isinstance(token, str):
+        return None, "token must be a string"
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None, "malformed token"
+    encoded_header, encoded_payload, encoded_signature = parts
+    expected_signature = base64_encode(hmac_sha256(encoded_header + '.' + encoded_payload))
+    if not hmac.compare_digest(expected_signature.encode('utf-8'), encoded_signature.encode('utf-8', 'replace')):
+        return None, "signature verification failed"
+    try:
+        claims = json.loads(b64url_decode(encoded_payload))
+    except ValueError:
+        return None, "malformed payload"
+    if not isinstance(claims, dict):
+        return None, "malformed payload"
+    expires_at = claims.get("exp")
+    if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+        return None, "token expired"
+    return claims, None
@@ -0,0 +1,294 @@
+"""Load test for the two services.
+
+Boots the auth service and the URL shortener as local subprocesses on a throwaway database, seeds mappings from
+read_from.csv plus generated URLs, runs one or more mixed workloads with concurrent clients and writes throughput
+and latency percentiles to a JSON file. Everything runs on localhost.
+
+    python benchmarks/load_test.py run --workloads redirect-heavy,create-heavy --clients 16 --duration 20
+    python benchmarks/load_test.py compare benchmarks/results/load-<old>.json benchmarks/results/load-<new>.json
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# operation -> weight per workload
+WORKLOADS = {
+    "redirect-heavy": {"redirect": 95, "create": 5},
+    "create-heavy": {"create": 70, "batch_create": 10, "redirect": 20},
+    "auth-heavy": {"stats": 40, "update": 25, "list": 15, "login": 10, "create": 10},
+}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def seed_urls(count):
+    """URLs from read_from.csv, topped up with generated ones."""
+    urls = []
+    with open(os.path.join(ROOT, "read_from.csv")) as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            urls.extend(row[:3])
+    urls = [url for url in urls if url]
+    while len(urls) < count:
+        urls.append(f"https://example.com/articles/{len(urls)}-{secrets.token_hex(4)}")
+    return urls[:count]
+
+class Services:
+    """Auth service and URL shortener running as subprocesses on free ports and a temporary data directory"""
+
+    def __init__(self, server_mode, extra_env):
+        self.data_dir = tempfile.mkdtemp(prefix="shortener-bench-")
+        self.auth_port = free_port()
+        self.shortener_port = free_port()
+        self.auth_url = f"http://127.0.0.1:{self.auth_port}"
+        self.shortener_url = f"http://127.0.0.1:{self.shortener_port}"
+        self.env = dict(os.environ, DB_MOUNT_POINT=self.data_dir, JWT_SECRET_KEY=secrets.token_urlsafe(32),
+                        AUTH_SERVICE_HOST="127.0.0.1", AUTH_SERVICE_PORT=str(self.auth_port),
+                        SHORTENER_SERVICE_PORT=str(self.shortener_port), SERVER_MODE=server_mode,
+                        PYTHONPATH=ROOT, **extra_env)
+        self.processes = []
+
+    def __enter__(self):
+        for module in ("auth_service.app", "url_shortener_service.app"):
+            log = open(os.path.join(self.data_dir, f"{module}.log"), "w")
+            self.processes.append(subprocess.Popen([sys.executable, "-m", module], cwd=ROOT, env=self.env,
+                                                   stdout=log, stderr=subprocess.STDOUT, start_new_session=True))
+        self.__wait_ready(f"{self.auth_url}/metrics")
+        self.__wait_ready(f"{self.shortener_url}/metrics")
+        return self
+
+    def __exit__(self, *exc):
+        # signal the whole process group, the dev server's reloader and gunicorn workers included
+        for process in self.processes:
+            os.killpg(process.pid, signal.SIGTERM)
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+
+    def __wait_ready(self, url, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if any(process.poll() is not None for process in self.processes):
+                raise RuntimeError(f"service exited during startup, see logs in {self.data_dir}")
+            try:
+                requests.get(url, timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+class Client:
+    """One simulated client with its own keep-alive session"""
+
+    def __init__(self, services, token, user, short_ids, urls):
+        self.services = services
+        self.token = token
+        self.user = user
+        self.short_ids = short_ids
+        self.urls = urls
+        self.session = requests.Session()
+
+    def redirect(self):
+        return self.session.get(f"{self.services.shortener_url}/{random.choice(self.short_ids)}",
+                                allow_redirects=False)
+
+    def create(self):
+        return self.session.post(f"{self.services.shortener_url}/", headers={"Authorization": self.token},
+                                 json={"url": random.choice(self.urls)})
+
+    def batch_create(self):
+        return self.session.post(f"{self.services.shortener_url}/batch", headers={"Authorization": self.token},
+                                 json=random.sample(self.urls, min(100, len(self.urls))))
+
+    def stats(self):
+        return self.session.get(f"{self.services.shortener_url}/stats/{random.choice(self.short_ids)}",
+                                headers={"Authorization": self.token})
+
+    def update(self):
+        return self.session.put(f"{self.services.shortener_url}/{random.choice(self.short_ids)}",
+                                headers={"Authorization": self.token}, json={"url": random.choice(self.urls)})
+
+    def list(self):
+        return self.session.get(f"{self.services.shortener_url}/", headers={"Authorization": self.token},
+                                params={"limit": 100})
+
+    def login(self):
+        return self.session.post(f"{self.services.auth_url}/users/login", json=self.user)
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for _, latency, _ in samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+def run_workload(name, services, token, user, short_ids, urls, clients, duration, warmup):
+    operations, weights = zip(*WORKLOADS[name].items())
+    samples = []
+    samples_lock = threading.Lock()
+    record_from = time.monotonic() + warmup
+    stop_at = record_from + duration
+
+    def client_loop():
+        client = Client(services, token, user, short_ids, urls)
+        local_samples = []
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            operation = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = getattr(client, operation)().status_code < 500
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - start
+            if now >= record_from:
+                local_samples.append((operation, latency, ok))
+        with samples_lock:
+            samples.extend(local_samples)
+
+    threads = [threading.Thread(target=client_loop) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    result = summarize(samples, duration)
+    result["per_operation"] = {operation: summarize([s for s in samples if s[0] == operation], duration)
+                               for operation in operations}
+    return result
+
+def run(args):
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    with Services(args.server_mode, extra_env) as services:
+        user = {"username": "bench", "password": secrets.token_urlsafe(12)}
+        requests.post(f"{services.auth_url}/users", json=user).raise_for_status()
+        token = requests.post(f"{services.auth_url}/users/login", json=user).json()["token"]
+
+        urls = seed_urls(max(args.seed, 1))
+        short_ids = []
+        for i in range(0, len(urls), 5000):
+            resp = requests.post(f"{services.shortener_url}/batch", headers={"Authorization": token},
+                                 json=urls[i:i + 5000])
+            resp.raise_for_status()
+            short_ids.extend(result["id"] for result in resp.json()["results"] if result["status"] == 201)
+
+        results = {}
+        for name in args.workloads.split(","):
+            print(f"running {name}: {args.clients} clients, {args.duration}s", file=sys.stderr)
+            results[name] = run_workload(name, services, token, user, short_ids, urls, args.clients,
+                                         args.duration, args.warmup)
+            print(f"  {results[name]['throughput_rps']} req/s, p50 {results[name]['latency_ms']['p50']} ms, "
+                  f"p99 {results[name]['latency_ms']['p99']} ms, {results[name]['errors']} errors", file=sys.stderr)
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "server_mode": args.server_mode,
+            "env": extra_env,
+            "clients": args.clients,
+            "duration_seconds": args.duration,
+            "warmup_seconds": args.warmup,
+            "seeded_mappings": len(short_ids),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}", file=sys.stderr)
+
+def compare(args):
+    """Print throughput and latency changes between two result files, per workload."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{'workload':<16}{'metric':<16}{baseline['meta']['commit']:>12}{candidate['meta']['commit']:>12}{'change':>10}")
+    for name, new in candidate["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        rows = [("req/s", old["throughput_rps"], new["throughput_rps"])]
+        rows += [(f"{key} ms", old["latency_ms"][key], new["latency_ms"][key]) for key in ("p50", "p95", "p99")]
+        for metric, old_value, new_value in rows:
+            change = f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else "n/a"
+            print(f"{name:<16}{metric:<16}{old_value:>12}{new_value:>12}{change:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="boot the services and run workloads")
+    run_parser.add_argument("--workloads", default=",".join(WORKLOADS), help="comma separated: " + ", ".join(WORKLOADS))
+    run_parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    run_parser.add_argument("--duration", type=float, default=10, help="measured seconds per workload")
+    run_parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each workload")
+    run_parser.add_argument("--seed", type=int, default=1000, help="mappings created before the workloads")
+    run_parser.add_argument("--server-mode", default="prod", choices=("dev", "prod", "asgi"))
+    run_parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                            help="extra environment for both services, e.g. --env AUTH_VERIFY_MODE=local")
+    run_parser.add_argument("--output", help="result file (default benchmarks/results/load-<commit>.json)")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Login throughput of the auth service's database path, against the pre-optimization path in reference_login.py.
+
+Seeds a temporary users.db with --users users, then runs --logins logins with random existing users (and the same
+number with wrong passwords) through both paths on --threads threads, in alternating rounds.
+
+    python benchmarks/login_bench.py                       # 100000 users
+    python benchmarks/login_bench.py --users 1000000 --threads 4
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def seed(db_path, users):
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO user_mappings (username, password) VALUES (?, ?)",
+                     ((f"user{i}", f"password-{i}") for i in range(users)))
+    conn.commit()
+    conn.close()
+
+def run_logins(login_fn, issue_token, attempts, threads):
+    """Logins per second, and whether each attempt got a token as expected."""
+    def attempt(item):
+        username, password, valid = item
+        return (login_fn(username, password, issue_token) is not None) == valid
+
+    start = time.perf_counter()
+    # the reference path prints every token
+    with contextlib.redirect_stdout(io.StringIO()):
+        if threads == 1:
+            results = list(map(attempt, attempts))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                results = list(executor.map(attempt, attempts))
+    return len(attempts) / (time.perf_counter() - start), all(results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000, help="users in the database")
+    parser.add_argument("--logins", type=int, default=500, help="successful logins per round and path")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="login-bench-")
+    os.environ["DB_MOUNT_POINT"] = data_dir
+    os.environ.setdefault("JWT_SECRET_KEY", "login-bench-secret-key")
+    sys.path.insert(0, os.path.dirname(ROOT))
+    sys.path.insert(0, ROOT)
+    try:
+        from auth_service import database
+        from auth_service.utils import generate_jwt
+        import reference_login
+
+        reference_login.DB_PATH = database.DATABASE_URL.replace("sqlite:///", "")
+        seed(reference_login.DB_PATH, args.users)
+        print(f"{args.users} users, {args.logins} logins and {args.logins} failed logins per round, "
+              f"{args.threads} thread(s)")
+
+        paths = {"current": database.login_user, "reference": reference_login.login_user}
+        rates = {name: [] for name in paths}
+        for _ in range(args.rounds):
+            users = random.sample(range(args.users), args.logins)
+            attempts = [(f"user{i}", f"password-{i}", True) for i in users]
+            attempts += [(f"user{i}", "wrong-password", False) for i in users]
+            random.shuffle(attempts)
+            for name, login_fn in paths.items():
+                rate, correct = run_logins(login_fn, generate_jwt, attempts, args.threads)
+                if not correct:
+                    sys.exit(f"{name} login path accepted or rejected the wrong credentials")
+                rates[name].append(rate)
+
+        current, reference = statistics.median(rates["current"]), statistics.median(rates["reference"])
+        print(f"{'path':<12}{'logins/s':>12}")
+        print(f"{'current':<12}{current:>12.0f}")
+        print(f"{'reference':<12}{reference:>12.0f}")
+        print(f"speedup: {current / reference:.1f}x")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
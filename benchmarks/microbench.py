@@ -0,0 +1,157 @@
+"""Microbenchmarks of the helpers that run on every request, with a regression guard.
+
+Each helper is timed in alternation with its pre-optimization version in reference_helpers.py. The reference code
+never changes, so the speedup over it is what gets compared with the stored baseline; that ratio carries over between
+machines far better than absolute timings do.
+
+    python benchmarks/microbench.py run                    # print timings
+    python benchmarks/microbench.py run --save-baseline    # record benchmarks/microbench_baseline.json
+    python benchmarks/microbench.py check --threshold 25   # exit 1 on a regression of more than 25%
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "microbench_baseline.json")
+SECRET = "microbench-secret-key"
+
+sys.path.insert(0, ROOT)
+os.environ.setdefault("JWT_SECRET_KEY", SECRET)
+
+from auth_service import utils as auth_utils  # noqa: E402
+from url_shortener_service import utils as shortener_utils  # noqa: E402
+import reference_helpers as reference  # noqa: E402
+
+reference.SECRET_KEY = auth_utils.SECRET_KEY
+
+URL = "https://en.wikipedia.org/wiki/Dijkstra's_algorithm"
+HEADER = json.dumps({"alg": "HS256", "typ": "JWT"})
+PAYLOAD = json.dumps({"sub": "auth", "name": "benchmark-user", "admin": True})
+TOKEN = auth_utils.construct_jwt(HEADER, PAYLOAD)
+
+# name -> (function, reference function, args)
+BENCHMARKS = {
+    "base62_encode": (shortener_utils.base62_encode, reference.base62_encode, (62 ** 7 - 12345,)),
+    "generate_short_id": (shortener_utils.generate_short_id, reference.generate_short_id, (URL,)),
+    "regex_validation": (shortener_utils.regex_validation, reference.regex_validation, (URL,)),
+    "regex_validate_jwt_string": (shortener_utils.regex_validate_jwt_string, reference.regex_validate_jwt_string,
+                                  (TOKEN,)),
+    "hmac_sha256": (auth_utils.hmac_sha256, reference.hmac_sha256, (TOKEN,)),
+    "construct_jwt": (auth_utils.construct_jwt, reference.construct_jwt, (HEADER, PAYLOAD)),
+    "verify_jwt": (auth_utils.verify_jwt, reference.verify_jwt, (TOKEN,)),
+}
+
+def time_rounds(fns, args, rounds):
+    """Nanoseconds per call of each function for every round. the functions take turns within a round, so load
+        changes on the machine affect them alike and ratios taken within a round stay stable"""
+    timers = [timeit.Timer(lambda fn=fn: fn(*args)) for fn in fns]
+    # about 20ms per function and round
+    numbers = [max(1, timer.autorange()[0] // 10) for timer in timers]
+    return [[timer.timeit(number) / number * 1e9 for timer, number in zip(timers, numbers)]
+            for _ in range(rounds)]
+
+def check_equivalence():
+    """The optimized helpers must return what the reference versions return."""
+    for name, (fn, reference_fn, args) in BENCHMARKS.items():
+        if name == "generate_short_id":
+            random.seed(1)
+            result = fn(*args)
+            random.seed(1)
+            expected = reference_fn(*args)
+        elif name == "regex_validate_jwt_string":
+            result, expected = bool(fn(*args)), bool(reference_fn(*args))
+        else:
+            result, expected = fn(*args), reference_fn(*args)
+        if result != expected:
+            raise AssertionError(f"{name}: {result!r} != reference {expected!r}")
+    for url in ("htInvalid_url/", "example.com", "http://www.example.com/a?b=c#d", "ftp://example.com"):
+        assert shortener_utils.regex_validation(url) == reference.regex_validation(url), url
+    tampered = TOKEN[:-2] + ("AA" if not TOKEN.endswith("AA") else "BB")
+    assert auth_utils.verify_jwt(tampered) is reference.verify_jwt(tampered) is False
+
+def measure(rounds):
+    results = {}
+    for name, (fn, reference_fn, args) in BENCHMARKS.items():
+        timings = time_rounds([fn, reference_fn], args, rounds)
+        results[name] = {
+            "ns_per_call": round(statistics.median(ns for ns, _ in timings), 1),
+            "reference_ns_per_call": round(statistics.median(reference_ns for _, reference_ns in timings), 1),
+            "speedup": round(statistics.median(reference_ns / ns for ns, reference_ns in timings), 3),
+        }
+    return results
+
+def regression(result, baseline_result):
+    """Slowdown against the baseline in percent, measured as the loss of speedup over the reference version."""
+    return (baseline_result["speedup"] / result["speedup"] - 1) * 100
+
+def print_table(results, baseline=None):
+    print(f"{'helper':<28}{'ns/call':>10}{'reference':>11}{'speedup':>9}{'vs baseline':>13}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline["results"]:
+            change = f"{regression(result, baseline['results'][name]):+.1f}%"
+        print(f"{name:<28}{result['ns_per_call']:>10}{result['reference_ns_per_call']:>11}"
+              f"{result['speedup']:>8.2f}x{change:>13}")
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def run(args):
+    check_equivalence()
+    results = measure(args.rounds)
+    print_table(results, load_baseline(args.baseline))
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+
+def check(args):
+    check_equivalence()
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        sys.exit(f"no baseline at {args.baseline}, record one with: run --save-baseline")
+    results = measure(args.rounds)
+    print_table(results, baseline)
+
+    failures = []
+    for name, result in results.items():
+        if name in baseline["results"]:
+            change = regression(result, baseline["results"][name])
+            if change > args.threshold:
+                failures.append(f"{name} is {change:.1f}% slower than the baseline (threshold {args.threshold}%)")
+        if result["speedup"] < 1:
+            failures.append(f"{name} is slower than its reference implementation ({result['speedup']}x)")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file")
+    parser.add_argument("--rounds", type=int, default=15, help="timing rounds per helper, the median counts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="time the helpers")
+    run_parser.add_argument("--save-baseline", action="store_true", help="store the timings as the new baseline")
+    run_parser.set_defaults(func=run)
+
+    check_parser = subparsers.add_parser("check", help="fail if a helper regressed against the baseline")
+    check_parser.add_argument("--threshold", type=float, default=float(os.getenv("MICROBENCH_THRESHOLD", 25)),
+                              help="allowed slowdown in percent (default 25, or MICROBENCH_THRESHOLD)")
+    check_parser.set_defaults(func=check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
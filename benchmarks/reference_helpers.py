@@ -0,0 +1,80 @@
+"""The helpers as they were before they were optimized, kept unchanged so microbench.py can show the gain.
+Not used by the services."""
+import hashlib
+import hmac
+import base64
+import random
+import string
+
+import regex
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+SECRET_KEY = None  # set by microbench.py
+
+def base62_encode(num):
+    """Encodes an integer into a Base62 string."""
+    if num == 0:
+        return BASE62_ALPHABET[0]
+
+    encoded = []
+    base = len(BASE62_ALPHABET)
+
+    while num:
+        num, remainder = divmod(num, base)
+        encoded.append(BASE62_ALPHABET[remainder])
+
+    return ''.join(reversed(encoded))
+
+def generate_short_id(url, length=6):
+    """Generates a unique short ID for a URL."""
+    randomNum = ''.join(random.choices(BASE62_ALPHABET, k=8))
+    hash_digest = hashlib.sha256((url + randomNum).encode()).hexdigest()
+    num = int(hash_digest[:10], 16)
+    return base62_encode(num)[:length]
+
+def regex_validation(url):
+    """Check whether url follows valid structure"""
+    url_regex = r"^((?:http(s)?):\/\/)?(www\\.)?(?!\\.|\\-|www\\.)([a-zA-Z0-9_.-]+)(\.[A-Za-z]{2,})((\/)[A-Za-z0-9\\-–.__~#!$&'()*+,;=:@\/?]*)?$"
+    if regex.match(url_regex, url):
+        return 0
+    return 1
+
+def regex_validate_jwt_string(str):
+    return regex.match("^[A-Za-z0-9_-]{2,}(\\.[A-Za-z0-9_-]{2,}){2}$", str)
+
+def hmac_sha256(message):
+    """Encodes a message and secret into a hmac_sha256 string."""
+    return hmac.new(SECRET_KEY.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).digest()
+
+def base64_encode(byte_input):
+    """Encodes byte input into a Base64 string."""
+    return base64.urlsafe_b64encode(byte_input).decode('utf-8').rstrip('=')
+
+def construct_jwt(header, payload):
+    message = base64_encode(header.encode("utf-8")) + '.' + base64_encode(payload.encode("utf-8"))
+    signature = hmac_sha256(message)
+    jwt = message + '.' + base64_encode(signature)
+    return jwt
+
+def add_padding(str):
+    if (len(str) % 4 != 0):
+        padding_needed = 4 - (len(str) % 4)
+        str += '==='[:padding_needed]
+    return str
+
+def verify_jwt(token):
+    token_parts = token.split('.')
+    encoded_header, encoded_payload, encoded_signature = token_parts
+
+    header_bytes = base64.urlsafe_b64decode(add_padding(encoded_header))
+    payload_bytes = base64.urlsafe_b64decode(add_padding(encoded_payload))
+
+    header = header_bytes.decode('utf-8')
+    payload = payload_bytes.decode('utf-8')
+
+    verification_token = construct_jwt(header, payload)
+    verification_parts = verification_token.split('.')
+    verify_header, verify_payload, verify_signature = verification_parts
+
+    if(verify_signature == encoded_signature): return True
+    else: return False
@@ -0,0 +1,54 @@
+"""The login path of auth_service/database.py as it was before it became one indexed transaction, kept unchanged
+(apart from the database path) so login_bench.py can show the gain. Not used by the services."""
+import sqlite3
+
+DB_PATH = None  # set by login_bench.py
+
+def __get_db_connection():
+    """Establish a connection to the database."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row    
+    return conn
+
+def check_user_exists(username):
+    try:
+        conn = __get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT username FROM user_mappings WHERE username = ?", (username,))
+        result = cursor.fetchone()
+        return True if result else False  
+    except sqlite3.IntegrityError:
+        return False  
+
+def authenticate_user(username, password):
+    """Attempt to access the user with username and password."""
+    try:
+        conn = __get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT ? FROM user_mappings WHERE password = ?", (username, password))
+        result = cursor.fetchone()
+        conn.close()
+        return True if result else False  
+    except sqlite3.IntegrityError:
+        return False  
+
+def update_token(token, username):
+    """Update an existing user's password mapping."""
+    conn = __get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE user_mappings SET token = ? WHERE username = ?", (token, username))
+    print(token)
+    conn.commit()
+    updated_rows = cursor.rowcount 
+    conn.close()
+    return True
+
+def login_user(username, password, issue_token):
+    """The three calls the login route made, in the same order."""
+    if check_user_exists(username) is False:
+        return None
+    if authenticate_user(username, password) is False:
+        return None
+    token = issue_token(username)
+    update_token(token, username)
+    return token
@@ -1,8 +1,15 @@
 import unittest
 import requests
+import base64
 import json
 import csv
 import random
+import time
+import hashlib
+import hmac
+import os
+import uuid
+from datetime import datetime, timezone
 
 
 class TestApi(unittest.TestCase):
@@ -91,6 +98,46 @@ class TestApi(unittest.TestCase):
 
         self.assertEqual(response.status_code, 404, f"Expected status code 404, but got {response.status_code}")
 
+    """
+    /:id GET, caching and REDIRECT_MODE=http
+    The JSON answer carries Cache-Control and an ETag, If-None-Match with that ETag is answered with 304. With
+    REDIRECT_MODE=http browsers get a redirect to the absolute URL instead, JSON only if they ask for it.
+    """
+
+    def test_get_conditional(self):
+        url = f"{self.base_url}/{self.id_shortened_url_1}"
+        response = requests.get(url, headers={'Accept': 'application/json'}, allow_redirects=False)
+        self.assertEqual(response.status_code, 301, f"Expected status code 301, but got {response.status_code}")
+        self.assertIn("max-age=", response.headers.get("Cache-Control", ""))
+        etag = response.headers.get("ETag")
+        self.assertIsNotNone(etag, "Expected an ETag header")
+
+        response = requests.get(url, headers={'Accept': 'application/json', 'If-None-Match': etag}, allow_redirects=False)
+        self.assertEqual(response.status_code, 304, f"Expected status code 304, but got {response.status_code}")
+        self.assertEqual(response.headers.get("ETag"), etag)
+        self.assertEqual(response.content, b"")
+
+        response = requests.get(url, headers={'Accept': 'application/json', 'If-None-Match': '"other"'}, allow_redirects=False)
+        self.assertEqual(response.status_code, 301, f"Expected status code 301, but got {response.status_code}")
+
+    def test_get_http_redirect(self):
+        response = requests.post(f"{self.base_url}/", headers=self.headers, json={'value': 'example.com/page'})
+        self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+        url = f"{self.base_url}/{response.json()['id']}"
+
+        response = requests.get(url, headers={'Accept': 'text/html'}, allow_redirects=False)
+        if response.status_code == 301 and response.headers.get("Location") is None:
+            self.skipTest("the service runs with REDIRECT_MODE=json")
+        self.assertIn(response.status_code, (301, 302, 303, 307, 308))
+        # a URL stored without a scheme must not be resolved relative to the shortener
+        self.assertEqual(response.headers.get("Location"), "http://example.com/page")
+        self.assertIn("max-age=", response.headers.get("Cache-Control", ""))
+        self.assertIn("Accept", response.headers.get("Vary", ""))
+
+        response = requests.get(url, headers={'Accept': 'application/json'}, allow_redirects=False)
+        self.assertEqual(response.status_code, 301, f"Expected status code 301, but got {response.status_code}")
+        self.assertEqual(response.json().get("value"), "example.com/page")
+
     """
     /:id PUT 
     Updates the URL behind the given ID. To do so, in addition to the parameter in the URL, 
@@ -150,6 +197,154 @@ class TestApi(unittest.TestCase):
         response = requests.delete(url, headers=self.headers)
         self.assertEqual(response.status_code, 404, f"Expected status code 404, but got {response.status_code}")
 
+    """
+    /:id PUT, DELETE by another user
+    A user may only change their own mappings: 403 for a mapping owned by someone else, 404 for an ID that does not
+    exist, with AUTHZ_MODE=sql as well as AUTHZ_MODE=trigger. The auth service only issues admin tokens, so the
+    non-admin tokens are signed here with the JWT_SECRET_KEY the services run with.
+    """
+
+    def mint_token(self, username):
+        secret = os.getenv("JWT_SECRET_KEY")
+        if not secret:
+            self.skipTest("JWT_SECRET_KEY is not set, cannot sign non-admin tokens")
+
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).decode("utf-8").rstrip("=")
+        now = round(time.time(), 3)
+        message = encode({"alg": "HS256", "typ": "JWT"}) + "." + encode(
+            {"sub": "auth", "name": username, "admin": False, "iat": now, "exp": int(now) + 600, "jti": uuid.uuid4().hex})
+        signature = hmac.new(secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).digest()
+        return message + "." + base64.urlsafe_b64encode(signature).decode("utf-8").rstrip("=")
+
+    def test_put_delete_not_owner(self):
+        owner = {'Authorization': self.mint_token("owner" + str(random.randint(0, 10 ** 9)))}
+        other = {'Authorization': self.mint_token("other" + str(random.randint(0, 10 ** 9)))}
+        response = requests.post(f"{self.base_url}/", headers=owner, json={'value': self.url_to_shorten_1})
+        self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+        url = f"{self.base_url}/{response.json()['id']}"
+        missing_url = f"{self.base_url}/{self.not_existing_id}"
+
+        response = requests.put(url, headers=other, data=json.dumps({'url': self.url_after_update}))
+        self.assertEqual(response.status_code, 403, f"Expected status code 403, but got {response.status_code}")
+        response = requests.delete(url, headers=other)
+        self.assertEqual(response.status_code, 403, f"Expected status code 403, but got {response.status_code}")
+        response = requests.put(missing_url, headers=other, data=json.dumps({'url': self.url_after_update}))
+        self.assertEqual(response.status_code, 404, f"Expected status code 404, but got {response.status_code}")
+        response = requests.delete(missing_url, headers=other)
+        self.assertEqual(response.status_code, 404, f"Expected status code 404, but got {response.status_code}")
+
+        # the mapping is unchanged, and its owner can still update and delete it
+        response = requests.get(url)
+        self.assertEqual(response.json().get("value"), self.url_to_shorten_1)
+        response = requests.put(url, headers=owner, data=json.dumps({'url': self.url_after_update}))
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        response = requests.delete(url, headers=owner)
+        self.assertEqual(response.status_code, 204, f"Expected status code 204, but got {response.status_code}")
+
+    """
+    /:id PUT, DELETE and the redirect cache
+    With several worker processes (SERVER_MODE=prod), each one caches the mapping. An update or delete must reach the
+    caches of all of them, not only the one of the worker that handled it.
+    """
+
+    def warm_caches(self, url, expected_value):
+        # separate connections spread the requests over the worker processes
+        for _ in range(20):
+            response = requests.get(url, headers={'Connection': 'close'})
+            self.assertEqual(response.json().get("value"), expected_value)
+
+    def test_put_then_redirect(self):
+        url = f"{self.base_url}/{self.id_shortened_url_1}"
+        self.warm_caches(url, self.url_to_shorten_1)
+
+        response = requests.put(url, headers=self.headers, data=json.dumps({'url': self.url_after_update}))
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        for _ in range(20):
+            response = requests.get(url, headers={'Connection': 'close'})
+            self.assertEqual(response.json().get("value"), self.url_after_update,
+                             f"Expected {self.url_after_update} after the update, but got {response.json().get('value')}")
+
+    def test_delete_then_redirect(self):
+        url = f"{self.base_url}/{self.id_shortened_url_1}"
+        self.warm_caches(url, self.url_to_shorten_1)
+
+        response = requests.delete(url, headers=self.headers)
+        self.assertEqual(response.status_code, 204, f"Expected status code 204, but got {response.status_code}")
+        for _ in range(20):
+            response = requests.get(url, headers={'Connection': 'close'})
+            self.assertEqual(response.status_code, 404, f"Expected status code 404 after the delete, but got {response.status_code}")
+
+    """
+    /stats/:id GET
+    Returns the number of times the short URL was accessed, including accesses that the serving process has not yet
+    flushed to the database.
+    """
+
+    def test_get_stats(self):
+        endpoint = "/"
+        id = self.id_shortened_url_1
+        for _ in range(3):
+            requests.get(f"{self.base_url}{endpoint}{id}")
+
+        url = f"{self.base_url}{endpoint}stats/{id}"
+        response = requests.get(url, headers=self.headers_wrong)
+        self.assertEqual(response.status_code, 403, f"Expected status code 403, but got {response.status_code}")
+
+        # clicks served by another worker process show up after its next click buffer flush
+        for _ in range(30):
+            response = requests.get(url, headers=self.headers)
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            if response.json().get("clicks") == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(response.json().get("clicks"), 3, f"Expected 3 clicks, but got {response.json().get('clicks')}")
+
+        url = f"{self.base_url}{endpoint}stats/Unseen_id"
+        response = requests.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 404, f"Expected status code 404, but got {response.status_code}")
+
+    def wait_for_series(self, url, params, total):
+        # clicks reach the minute buckets with the next analytics flush, the hour and day buckets with the next rollup
+        for _ in range(30):
+            response = requests.get(url, headers=self.headers, params=params)
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            if response.json()["total"] == total:
+                break
+            time.sleep(0.1)
+        return response.json()
+
+    def test_get_stats_series(self):
+        id = self.id_shortened_url_2
+        for _ in range(3):
+            requests.get(f"{self.base_url}/{id}")
+        now = int(time.time())
+        url = f"{self.base_url}/stats/{id}"
+
+        # to as ISO 8601, the minute of the clicks may still be open
+        to = datetime.fromtimestamp(now + 60, timezone.utc).isoformat()
+        series = self.wait_for_series(url, {'from': now - 3600, 'to': to, 'granularity': 'minute'}, 3)
+        self.assertEqual(series["total"], 3, f"Expected 3 clicks, but got {series['total']}")
+        self.assertEqual(series["to"], now + 60)
+        self.assertEqual(series["total"], sum(bucket["clicks"] for bucket in series["buckets"]))
+        for bucket in series["buckets"]:
+            self.assertEqual(bucket["start"] % 60, 0)
+            self.assertTrue(now - 3600 - 60 < bucket["start"] <= now)
+
+        for params in ({'granularity': 'week'},
+                       {'from': now, 'to': now - 60, 'granularity': 'minute'},
+                       {'from': now - 86400 * 30, 'to': now, 'granularity': 'minute'},
+                       {'from': 'yesterday'}):
+            response = requests.get(url, headers=self.headers, params=params)
+            self.assertEqual(response.status_code, 400, f"Expected status code 400 for {params}, but got {response.status_code}")
+
+        # hour buckets are rolled up every ANALYTICS_ROLLUP_INTERVAL seconds
+        series = self.wait_for_series(url, {'from': now - 86400, 'to': now + 3600, 'granularity': 'hour'}, 3)
+        if series["total"] != 3:
+            self.skipTest("No rollup ran yet, lower ANALYTICS_ROLLUP_INTERVAL to test it")
+        self.assertEqual([bucket["start"] % 3600 for bucket in series["buckets"]], [0] * len(series["buckets"]))
+        self.assertEqual(series["total"], sum(bucket["clicks"] for bucket in series["buckets"]))
+
     """
     / GET   
     Should return a list of something at the global level. Can either be a list of all keys (IDs), all long URLs, 
@@ -167,6 +362,58 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
         self.assertIsNotNone(response.text, "Response text should not be None.")
 
+    def test_get_all_paginated(self):
+        endpoint = "/"
+        url = f"{self.base_url}{endpoint}"
+        ids = []
+        after = 0
+        while after is not None:
+            response = requests.get(url, headers=self.headers, params={'limit': 1, 'after': after})
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            self.assertLessEqual(len(response.json()["ids"]), 1)
+            ids += response.json()["ids"]
+            after = response.json()["next"]
+        self.assertIn(self.id_shortened_url_1, ids)
+        self.assertIn(self.id_shortened_url_2, ids)
+
+        response = requests.get(url, headers=self.headers, params={'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        streamed = [json.loads(line)["id"] for line in response.text.splitlines()]
+        self.assertEqual(streamed, ids)
+
+    def test_get_all_keyset_pages(self):
+        # with DB_SHARDS > 1 the pages are merged from all shards, the cursor must continue each of them correctly
+        url = f"{self.base_url}/"
+        created = {self.id_shortened_url_1, self.id_shortened_url_2}
+        for i in range(12):
+            response = requests.post(url, headers=self.headers, json={'value': f"https://example.com/page{i}"})
+            self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+            created.add(response.json()["id"])
+
+        ids, cursors = [], []
+        after = 0
+        while after is not None:
+            response = requests.get(url, headers=self.headers, params={'limit': 5, 'after': after})
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            page, after = response.json()["ids"], response.json()["next"]
+            # only the last page may be short
+            self.assertEqual(len(page), 5 if after is not None else len(page))
+            self.assertLessEqual(len(page), 5)
+            ids += page
+            if after is not None:
+                cursors.append(after)
+        self.assertEqual(len(ids), len(set(ids)), "A short ID was listed on more than one page")
+        self.assertEqual(set(ids), created)
+        self.assertEqual(cursors, sorted(set(cursors)), "Cursors must strictly increase")
+
+        # the last cursor gives the last page again, the unpaged stream has the same order
+        response = requests.get(url, headers=self.headers, params={'limit': 5, 'after': cursors[-1]})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        self.assertEqual(response.json()["ids"], ids[len(cursors) * 5:])
+        self.assertIsNone(response.json()["next"])
+        response = requests.get(url, headers=self.headers, params={'format': 'ndjson'})
+        self.assertEqual([json.loads(line)["id"] for line in response.text.splitlines()], ids)
+
     """
     / POST    
     Should create a new short URL / ID for the given long URL (which must be given in the body). Returns a 201 with 
@@ -207,6 +454,182 @@ class TestApi(unittest.TestCase):
         response = requests.post(url, headers=self.headers, json={'value': str(url_to_shorten)})
         self.assertEqual(response.status_code, 400, f"Expected status code 400, but got {response.status_code}")
 
+    def test_post_custom_id(self):
+        endpoint = "/"
+        url = f"{self.base_url}{endpoint}"
+        custom_id = "custom" + str(random.randint(0, 10 ** 9))
+        response = requests.post(url, headers=self.headers, json={'value': self.url_to_shorten_1, 'short_id': custom_id})
+        self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+        self.assertEqual(response.json().get("id"), custom_id)
+
+        # a custom ID can only be taken once
+        response = requests.post(url, headers=self.headers, json={'value': self.url_to_shorten_2, 'short_id': custom_id})
+        self.assertEqual(response.status_code, 400, f"Expected status code 400, but got {response.status_code}")
+
+    """
+    /batch POST
+    Creates short URLs for many URLs in one request and returns a result per item, in input order.
+    """
+
+    def test_post_batch(self):
+        endpoint = "/batch"
+        url = f"{self.base_url}{endpoint}"
+        custom_id = "batch" + str(random.randint(0, 10 ** 9))
+        items = [self.url_to_shorten_1,
+                 {'url': self.url_to_shorten_2, 'short_id': custom_id},
+                 {'url': self.url_to_shorten_2, 'short_id': custom_id},
+                 self.invalid_url]
+
+        response = requests.post(url, headers=self.headers_wrong, json=items)
+        self.assertEqual(response.status_code, 403, f"Expected status code 403, but got {response.status_code}")
+
+        response = requests.post(url, headers=self.headers, json=items)
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        results = response.json()["results"]
+        self.assertEqual([result["status"] for result in results], [201, 201, 400, 400])
+        self.assertEqual(results[1]["id"], custom_id)
+
+        response = requests.get(f"{self.base_url}/{results[0]['id']}")
+        self.assertEqual(response.json().get("value"), self.url_to_shorten_1)
+
+        # JSON Lines body
+        lines = "\n".join(json.dumps({'url': self.url_to_shorten_1}) for _ in range(3))
+        response = requests.post(url, headers={**self.headers, 'Content-Type': 'application/x-ndjson'}, data=lines)
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        self.assertEqual(response.json()["created"], 3)
+
+    """
+    /users/logout POST, /users PUT, /tokens/revocations GET
+    Logging out revokes the token, changing the password revokes all tokens issued before. Revocations are published
+    in the feed, and the URL shortener rejects revoked tokens, also when it verifies them locally from that feed.
+    """
+
+    def login_new_user(self, password):
+        username = "revoke" + str(random.randint(0, 10 ** 9))
+        requests.post(self.url_create, json={'username': username, 'password': password})
+        response = requests.post(self.url_login, json={'username': username, 'password': password})
+        self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+        return username, response.json()["token"]
+
+    def read_revocation_feed(self):
+        revocations = []
+        since = 0
+        while True:
+            response = requests.get(f"{self.auth_url}/tokens/revocations", params={'since': since})
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            feed = response.json()
+            revocations += feed["revocations"]
+            self.assertGreaterEqual(feed["version"], max([since] + [revocation["version"] for revocation in feed["revocations"]]))
+            since = feed["version"]
+            if not feed["more"]:
+                return revocations
+
+    def assert_rejected(self, token):
+        # a shortener verifying tokens locally picks the revocation up with its next feed poll
+        for _ in range(100):
+            response = requests.get(f"{self.base_url}/", headers={'Authorization': token})
+            if response.status_code == 403:
+                break
+            time.sleep(0.1)
+        self.assertEqual(response.status_code, 403, f"Expected status code 403, but got {response.status_code}")
+
+    def test_logout_revokes_token(self):
+        _, token = self.login_new_user("secret")
+        payload = token.split(".")[1]
+        jti = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["jti"]
+
+        response = requests.post(f"{self.auth_url}/users/logout", json={'token': 'wrong'})
+        self.assertEqual(response.status_code, 400, f"Expected status code 400, but got {response.status_code}")
+        response = requests.post(f"{self.auth_url}/users/logout", headers={'Authorization': token})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+
+        self.assertIn(jti, [revocation.get("jti") for revocation in self.read_revocation_feed()])
+        response = requests.post(self.url_login, json={'token': token})
+        self.assertEqual(response.status_code, 400, f"Expected status code 400, but got {response.status_code}")
+        self.assert_rejected(token)
+
+    def test_password_change_revokes_tokens(self):
+        username, token = self.login_new_user("secret")
+        response = requests.put(self.url_create, json={'username': username, 'old-password': 'secret',
+                                                       'new-password': 'secret2'})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+
+        self.assertIn(username, [revocation.get("user") for revocation in self.read_revocation_feed()])
+        self.assert_rejected(token)
+
+        # tokens issued after the change are accepted
+        response = requests.post(self.url_login, json={'username': username, 'password': 'secret2'})
+        self.assertEqual(response.status_code, 201, f"Expected status code 201, but got {response.status_code}")
+        response = requests.get(f"{self.base_url}/", headers={'Authorization': response.json()["token"]})
+        self.assertNotEqual(response.status_code, 403, "A token issued after the password change was rejected")
+
+    def test_verify_tokens_batch(self):
+        _, logged_out = self.login_new_user("secret")
+        response = requests.post(f"{self.auth_url}/users/logout", headers={'Authorization': logged_out})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        username, changed = self.login_new_user("secret")
+        requests.put(self.url_create, json={'username': username, 'old-password': 'secret', 'new-password': 'secret2'})
+        fresh = requests.post(self.url_login, json={'username': username, 'password': 'secret2'}).json()["token"]
+
+        tokens = [logged_out, self.headers['Authorization'], changed, fresh, "not-a-token"]
+        response = requests.post(f"{self.auth_url}/tokens/verify", json={'tokens': tokens})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        results = response.json()["results"]
+        self.assertEqual([result["valid"] for result in results], [False, True, False, True, False])
+        self.assertEqual(results[0]["error"], "token revoked")
+        self.assertEqual(results[2]["error"], "token revoked")
+        self.assertEqual(results[3]["claims"]["name"], username)
+
+    """
+    /users GET
+    Lists the users with the fields given in ?fields= (username by default), one page at a time with ?limit=&after=,
+    the response carries the cursor of the next page.
+    """
+
+    def test_get_users_paginated(self):
+        usernames = {self.login_new_user("secret")[0] for _ in range(5)}
+        pages = []
+        after = 0
+        while after is not None:
+            response = requests.get(self.url_create, params={'limit': 2, 'after': after, 'fields': 'id,username'})
+            self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+            page = response.json()
+            self.assertLessEqual(len(page["users"]), 2)
+            if page["next"] is not None:
+                self.assertGreater(page["next"], after)
+                self.assertEqual(page["next"], page["users"][-1]["id"])
+            pages += page["users"]
+            after = page["next"]
+
+        ids = [user["id"] for user in pages]
+        self.assertEqual(ids, sorted(set(ids)), "Pages overlap or are out of order")
+        self.assertTrue(usernames <= {user["username"] for user in pages})
+
+        response = requests.get(self.url_create, params={'format': 'ndjson', 'fields': 'id,username'})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        self.assertEqual([json.loads(line) for line in response.text.splitlines()], pages)
+
+    def test_get_users_fields(self):
+        username, _ = self.login_new_user("secret")
+        response = requests.get(self.url_create)
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        users = response.json()["users"]
+        self.assertIn({'username': username}, users)
+        self.assertTrue(all(set(user) == {'username'} for user in users), "Only the username is listed by default")
+
+        response = requests.get(self.url_create, params={'fields': 'username,token'})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        user = next(user for user in response.json()["users"] if user["username"] == username)
+        self.assertEqual(set(user), {'username', 'token'})
+
+        response = requests.get(self.url_create, params={'fields': 'username,password'})
+        self.assertEqual(response.status_code, 200, f"Expected status code 200, but got {response.status_code}")
+        user = next(user for user in response.json()["users"] if user["username"] == username)
+        self.assertEqual(set(user), {'username', 'password'})
+
+        response = requests.get(self.url_create, params={'fields': 'username,email'})
+        self.assertEqual(response.status_code, 400, f"Expected status code 400, but got {response.status_code}")
+
     """
     / DELETE    
     Deletes all ID/URL pairs in the service.
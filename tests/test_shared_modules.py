@@ -0,0 +1,22 @@
+import unittest
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules copied into both services, since each image only contains its own package
+SHARED_MODULES = ("metrics.py", "background.py")
+
+
+class TestSharedModules(unittest.TestCase):
+    def test_copies_are_identical(self):
+        for module in SHARED_MODULES:
+            with open(os.path.join(ROOT, "auth_service", module), "rb") as f:
+                auth_copy = f.read()
+            with open(os.path.join(ROOT, "url_shortener_service", module), "rb") as f:
+                shortener_copy = f.read()
+            self.assertEqual(auth_copy, shortener_copy,
+                             f"auth_service/{module} and url_shortener_service/{module} differ, change both")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+import hashlib
+import base64
+import hmac
+import json
+import time
+import uuid
+
+from url_shortener_service import utils
+from url_shortener_service.auth_client import AuthServiceUnavailable
+from url_shortener_service.revocations import RevocationSet
+
+SECRET = "test-secret"
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode("utf-8").rstrip("=")
+
+
+def make_token(name="alice", ttl=3600):
+    """HS256 token in the format the auth service issues."""
+    now = time.time()
+    header = b64url(json.dumps({"alg": "HS256", "typ": "JWT"}).encode("utf-8"))
+    payload = b64url(json.dumps({"sub": "auth", "name": name, "iat": now, "exp": now + ttl,
+                                 "jti": uuid.uuid4().hex}).encode("utf-8"))
+    signature = hmac.new(SECRET.encode("utf-8"), f"{header}.{payload}".encode("utf-8"), hashlib.sha256).digest()
+    return f"{header}.{payload}.{b64url(signature)}"
+
+
+def claims_of(token):
+    return json.loads(utils.b64url_decode(token.split(".")[1]))
+
+
+class TestLocalFallback(unittest.TestCase):
+    """Remote verification with AUTH_LOCAL_FALLBACK while the auth service is down."""
+
+    def setUp(self):
+        self.auth_up = True
+        self.revocations = []
+        self.revocation_set = RevocationSet(self.fetch_feed, poll_interval=3600, max_staleness=60)
+        for patch in (mock.patch.object(utils, "AUTH_VERIFY_MODE", "remote"),
+                      mock.patch.object(utils, "AUTH_LOCAL_FALLBACK", True),
+                      mock.patch.object(utils, "JWT_SECRET_KEY", SECRET),
+                      mock.patch.object(utils, "revocation_set", self.revocation_set),
+                      mock.patch.object(utils, "verify_jwt_remotely_cached", self.verify_remotely)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fetch_feed(self, since):
+        if not self.auth_up:
+            raise AuthServiceUnavailable("connection refused")
+        return {"version": len(self.revocations), "revocations": self.revocations[since:], "more": False}
+
+    def verify_remotely(self, jwt):
+        if not self.auth_up:
+            raise AuthServiceUnavailable("connection refused")
+        return claims_of(jwt)
+
+    def logout(self, token):
+        claims = claims_of(token)
+        self.revocations.append({"version": len(self.revocations) + 1, "jti": claims["jti"],
+                                 "expires_at": claims["exp"]})
+
+    def test_revoked_token_rejected_during_outage(self):
+        token, revoked = make_token(), make_token()
+        self.assertEqual(utils.verify_jwt(revoked), claims_of(revoked))
+        self.logout(revoked)
+        self.revocation_set.sync()
+
+        self.auth_up = False
+        self.assertIsNone(utils.verify_jwt(revoked))
+        self.assertEqual(utils.verify_jwt(token), claims_of(token))
+
+    def test_no_fallback_with_stale_revocations(self):
+        token = make_token()
+        self.auth_up = False
+        # the feed could never be polled, so a logout would go unnoticed
+        with self.assertRaises(AuthServiceUnavailable):
+            utils.verify_jwt(token)
+
+
+if __name__ == "__main__":
+    unittest.main()
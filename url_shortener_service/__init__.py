@@ -6,5 +6,12 @@ def create_shortener():
     from url_shortener_service.routes import main
     app.register_blueprint(main) 
 
+    from url_shortener_service import metrics
+    metrics.init_app(app)
+
     return app
 
+def create_shortener_async():
+    """ASGI variant of create_shortener, serving the same routes with an asyncio front end."""
+    from url_shortener_service.asgi import ShortenerASGI
+    return ShortenerASGI(create_shortener())
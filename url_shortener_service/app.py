@@ -1,10 +1,29 @@
-from url_shortener_service import create_shortener
+from url_shortener_service import create_shortener, create_shortener_async
+import logging
 import os
+import signal
+import sys
+
+# "dev" runs the flask development server, "prod" the pre-fork gunicorn server, "asgi" the asyncio server (uvicorn)
+SERVER_MODE = os.getenv("SERVER_MODE", "dev").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 app = create_shortener()
 
 if __name__ == "__main__":
+    # background threads (flushes, rebuilds, polls) report failures through logging
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
     app.config.from_prefixed_env()
     host = "0.0.0.0"  # Ensures Flask listens on all interfaces
     port = int(os.getenv("SHORTENER_SERVICE_PORT", 8000))  # Read port from environment
-    app.run(host=host, port=port, debug=True)
\ No newline at end of file
+    if SERVER_MODE == "prod":
+        from url_shortener_service.server import ProductionServer
+        from url_shortener_service.database import close_db_connections
+        ProductionServer(app, f"{host}:{port}", on_ready=close_db_connections).run()
+    elif SERVER_MODE == "asgi":
+        import uvicorn
+        uvicorn.run(create_shortener_async(), host=host, port=port, lifespan="on")
+    else:
+        # exit through sys.exit on SIGTERM so atexit hooks (click buffer flush) run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        app.run(host=host, port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import time
+import sys
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from url_shortener_service.database import DB_POOL_SIZE, click_buffer
+from url_shortener_service.auth_client import (AUTH_CONNECT_TIMEOUT, AUTH_READ_TIMEOUT, AUTH_HTTP_POOL_SIZE,
+                                               auth_request_duration, auth_request_errors)
+from url_shortener_service.utils import (AUTH_VERIFY_MODE, TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_TTL, TOKENS_VERIFY_PATH,
+                                         auth_client, token_cache, token_cache_key, regex_validate_jwt_string,
+                                         verification_result)
+
+# threads running the (blocking) flask handlers and sqlite calls
+ASGI_EXECUTOR_WORKERS = int(os.getenv("ASGI_EXECUTOR_WORKERS", DB_POOL_SIZE))
+# max. tokens sent to the auth service in one verification call
+AUTH_VERIFY_BATCH_SIZE = int(os.getenv("AUTH_VERIFY_BATCH_SIZE", 100))
+
+class AsyncTokenVerifier:
+    """Verifies tokens against the auth service with a non-blocking client and stores the result in the shared
+        token cache, so check_authentication in the handler thread finds it there instead of making the HTTP call.
+        concurrent requests with the same token await the same verification, the different tokens of requests
+        arriving in the same event loop iteration are verified with one batch call"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._client = None
+        self._in_flight = {}
+        self._pending = {}
+        self._batch = None
+
+    def enabled(self):
+        return AUTH_VERIFY_MODE == "remote" and TOKEN_CACHE_MAX_ENTRIES > 0 and TOKEN_CACHE_TTL > 0
+
+    async def prefetch(self, jwt):
+        if not jwt or not regex_validate_jwt_string(jwt):
+            return
+        key = token_cache_key(jwt)
+        if token_cache.get(key) is not None:
+            return
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(self.__verify(key, jwt))
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        await asyncio.shield(task)
+
+    async def __verify(self, key, jwt):
+        # failures are left to the handler thread, which applies the fallback / 503 logic
+        if not auth_client.breaker.allow():
+            return
+        self._pending[key] = jwt
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self.__verify_pending())
+        await asyncio.shield(self._batch)
+
+    async def __verify_pending(self):
+        # let the other requests of this loop iteration add their tokens first
+        await asyncio.sleep(0)
+        pending, self._pending, self._batch = list(self._pending.items()), {}, None
+        await asyncio.gather(*(self.__verify_batch(pending[i:i + AUTH_VERIFY_BATCH_SIZE])
+                               for i in range(0, len(pending), AUTH_VERIFY_BATCH_SIZE)))
+
+    async def __verify_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            resp = await self.__client().post(f"{self.base_url}{TOKENS_VERIFY_PATH}",
+                                              json={"tokens": [jwt for _, jwt in batch]})
+        except httpx.HTTPError as e:
+            auth_client.breaker.record(False)
+            auth_request_errors.inc(("timeout" if isinstance(e, httpx.TimeoutException) else "connection",))
+            return
+        finally:
+            auth_request_duration.observe(time.perf_counter() - start)
+        auth_client.breaker.record(resp.status_code < 500)
+        if resp.status_code >= 500:
+            auth_request_errors.inc(("status_5xx",))
+        elif resp.status_code == 200:
+            for (key, _), result in zip(batch, resp.json()["results"]):
+                token_cache.put(key, verification_result(result))
+
+    def __client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(AUTH_READ_TIMEOUT, connect=AUTH_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=AUTH_HTTP_POOL_SIZE, max_keepalive_connections=AUTH_HTTP_POOL_SIZE))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class ShortenerASGI:
+    """ASGI application serving the routes of the flask app. connections, request bodies and responses are handled
+        on the event loop; the route handlers (and their sqlite access) run on a dedicated thread pool, and token
+        verification against the auth service is done with an async client before the handler runs"""
+
+    def __init__(self, flask_app, executor_workers=ASGI_EXECUTOR_WORKERS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="shortener-handler")
+        self.token_verifier = AsyncTokenVerifier(auth_client.base_url)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.__lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.__http(scope, receive, send)
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.token_verifier.aclose()
+                await asyncio.get_running_loop().run_in_executor(self.executor, click_buffer.flush)
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = await self.__read_body(receive)
+        environ = self.__environ(scope, body)
+
+        if self.token_verifier.enabled():
+            await self.token_verifier.prefetch(environ.get("HTTP_AUTHORIZATION"))
+
+        response_start = {}
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                         for name, value in headers]
+
+        app_iter = await loop.run_in_executor(self.executor, self.flask_app.wsgi_app, environ, start_response)
+        try:
+            await send({"type": "http.response.start", "status": response_start["status"],
+                        "headers": response_start["headers"]})
+            # streamed bodies (e.g. the GET / listing) read from sqlite, so they are iterated on the executor too
+            iterator = iter(app_iter)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(app_iter, "close"):
+                await loop.run_in_executor(self.executor, app_iter.close)
+
+    async def __read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    def __environ(self, scope, body):
+        """WSGI environ for an ASGI http scope (PEP 3333 strings are latin-1 decoded bytes)."""
+        server_name, server_port = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
@@ -0,0 +1,178 @@
+import threading
+import time
+import os
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from url_shortener_service.metrics import registry, gauge
+
+# HTTP client settings for calls to the auth service
+AUTH_CONNECT_TIMEOUT = float(os.getenv("AUTH_CONNECT_TIMEOUT", 0.5))  # seconds
+AUTH_READ_TIMEOUT = float(os.getenv("AUTH_READ_TIMEOUT", 2.0))  # seconds
+AUTH_HTTP_RETRIES = int(os.getenv("AUTH_HTTP_RETRIES", 2))
+AUTH_HTTP_POOL_SIZE = int(os.getenv("AUTH_HTTP_POOL_SIZE", 20))
+
+# circuit breaker settings
+AUTH_BREAKER_WINDOW = int(os.getenv("AUTH_BREAKER_WINDOW", 20))  # last N calls considered
+AUTH_BREAKER_MIN_CALLS = int(os.getenv("AUTH_BREAKER_MIN_CALLS", 5))
+AUTH_BREAKER_ERROR_RATE = float(os.getenv("AUTH_BREAKER_ERROR_RATE", 0.5))
+AUTH_BREAKER_COOLDOWN = float(os.getenv("AUTH_BREAKER_COOLDOWN", 10))  # seconds
+
+auth_request_duration = registry.histogram("auth_request_duration_seconds",
+                                           "Latency of calls to the auth service (including retries)")
+auth_request_errors = registry.counter("auth_request_errors_total", "Failed or rejected calls to the auth service",
+                                       ("reason",))
+
+class AuthServiceUnavailable(Exception):
+    """The auth service could not be reached, returned a server error or the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Error-rate circuit breaker. opens when the share of failures among the last `window` calls reaches
+        `error_rate`, rejects calls for `cooldown` seconds and then lets a single trial call through (half-open)"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window=AUTH_BREAKER_WINDOW, min_calls=AUTH_BREAKER_MIN_CALLS,
+                 error_rate=AUTH_BREAKER_ERROR_RATE, cooldown=AUTH_BREAKER_COOLDOWN):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.times_opened = 0
+        self._results = deque(maxlen=window)
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may be made right now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_running = False
+                if success:
+                    self.state = self.CLOSED
+                    self._results.clear()
+                else:
+                    self.__open()
+                return
+            self._results.append(success)
+            failures = self._results.count(False)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+                self.__open()
+
+    def __open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self._results.clear()
+
+class AuthClient:
+    """Keep-alive HTTP client for the auth service with timeouts, bounded retries and a circuit breaker"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def post(self, path, json):
+        """POST json to the auth service and return the response. raises AuthServiceUnavailable on connection
+            errors, timeouts, 5xx responses or while the breaker is open"""
+        return self.__request("POST", path, json=json)
+
+    def get(self, path, params=None):
+        """GET from the auth service, with the same error handling as post."""
+        return self.__request("GET", path, params=params)
+
+    def __request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            with self._lock:
+                self.rejected += 1
+            auth_request_errors.inc(("breaker_open",))
+            raise AuthServiceUnavailable("circuit breaker is open")
+
+        start = time.perf_counter()
+        try:
+            resp = self.__session().request(method, f"{self.base_url}{path}", **kwargs,
+                                            timeout=(AUTH_CONNECT_TIMEOUT, AUTH_READ_TIMEOUT))
+            success = resp.status_code < 500
+            if not success:
+                auth_request_errors.inc(("status_5xx",))
+        except requests.RequestException as e:
+            resp = None
+            success = False
+            error = e
+            auth_request_errors.inc(("timeout" if isinstance(e, requests.Timeout) else "connection",))
+        latency = time.perf_counter() - start
+        auth_request_duration.observe(latency)
+
+        self.breaker.record(success)
+        with self._lock:
+            self.calls += 1
+            self.failures += 0 if success else 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+        if resp is None:
+            raise AuthServiceUnavailable(str(error))
+        if not success:
+            raise AuthServiceUnavailable(f"auth service responded with {resp.status_code}")
+        return resp
+
+    def stats(self):
+        with self._lock:
+            return {
+                "breaker_state": self.breaker.state,
+                "breaker_times_opened": self.breaker.times_opened,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "avg_latency_seconds": self.total_latency / self.calls if self.calls else 0.0,
+                "max_latency_seconds": self.max_latency,
+            }
+
+    def collect_metrics(self):
+        """Breaker state as a gauge (0 closed, 1 half open, 2 open) for the metrics registry."""
+        state = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[self.breaker.state]
+        return [
+            gauge("auth_breaker_state", "Auth service circuit breaker state (0 closed, 1 half open, 2 open)",
+                  [({}, state)]),
+            ("auth_breaker_opened_total", "counter", "Times the auth service circuit breaker opened",
+             [({}, self.breaker.times_opened)]),
+        ]
+
+    def __session(self):
+        """Shared session with a pooled adapter, recreated after a fork so processes don't share sockets."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    retry = Retry(total=AUTH_HTTP_RETRIES, backoff_factor=0.05, status_forcelist=(502, 503, 504),
+                                  allowed_methods=None, raise_on_status=False)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AUTH_HTTP_POOL_SIZE, max_retries=retry)
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
@@ -0,0 +1,180 @@
+import logging
+import threading
+import hashlib
+import math
+import time
+import os
+from url_shortener_service.background import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# negative lookup filter settings
+BLOOM_FILTER_ENABLED = os.getenv("BLOOM_FILTER_ENABLED", "false").lower() == "true"
+BLOOM_FP_RATE = float(os.getenv("BLOOM_FP_RATE", 0.01))  # target false positive rate at capacity
+BLOOM_MAX_BYTES = int(os.getenv("BLOOM_MAX_BYTES", 16 * 1024 * 1024))  # memory budget of the bit array
+BLOOM_MIN_CAPACITY = int(os.getenv("BLOOM_MIN_CAPACITY", 100000))  # sized for at least this many IDs
+BLOOM_REBUILD_INTERVAL = float(os.getenv("BLOOM_REBUILD_INTERVAL", 3600))  # seconds, drops deleted IDs
+
+# rebuild early once this share of the entries was deleted, or the filter is over capacity
+BLOOM_REBUILD_DELETED_RATIO = 0.1
+
+class BloomFilter:
+    """Bit array Bloom filter with double hashing over one blake2b digest. sized for `capacity` keys at
+        `fp_rate`, but never larger than max_bytes (the false positive rate is then higher, see expected_fp_rate)"""
+
+    def __init__(self, capacity, fp_rate=BLOOM_FP_RATE, max_bytes=BLOOM_MAX_BYTES):
+        bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+        self.size = max(64, min(bits, max_bytes * 8))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.entries = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self.bytes = len(self._bits)
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """Not thread safe, concurrent adds to the same byte can lose a bit. callers serialize adds."""
+        bits = self._bits
+        for position in self.__positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.entries += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+    def expected_fp_rate(self):
+        return (1 - math.exp(-self.hashes * self.entries / self.size)) ** self.hashes
+
+class ShortIdFilter:
+    """Per-process Bloom filter over all short IDs, answering "definitely not stored" without a database query.
+        count_fn() returns the number of stored mappings, rows_after_fn(watermarks) yields (shard, id, short_id)
+        of every row with an id above the shard's watermark. version_fn() returns a value that changes whenever
+        the database was written, or None if that is unknown. rows created by other processes are picked up by a
+        catch-up sync before a negative answer, which is skipped while the version is unchanged. deleted IDs stay
+        in the filter (they only cost a query) until the next rebuild. until the first build is done every lookup
+        passes through"""
+
+    def __init__(self, count_fn, rows_after_fn, shards, version_fn=lambda: None, fp_rate=BLOOM_FP_RATE,
+                 max_bytes=BLOOM_MAX_BYTES, min_capacity=BLOOM_MIN_CAPACITY, rebuild_interval=BLOOM_REBUILD_INTERVAL):
+        self.count_fn = count_fn
+        self.rows_after_fn = rows_after_fn
+        self.shards = shards
+        self.version_fn = version_fn
+        self.fp_rate = fp_rate
+        self.max_bytes = max_bytes
+        self.min_capacity = min_capacity
+        self.rebuild_interval = rebuild_interval
+        self._filter = None
+        self._watermarks = None
+        self._version = None
+        self._built_at = 0
+        self._deleted = 0
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._builder = ProcessThread(self.__run, "short-id-filter-builder")
+        self.filtered = 0
+        self.passed = 0
+        self.false_positives = 0
+        self.syncs = 0
+        self.builds = 0
+        self.build_failures = 0
+
+    def might_exist(self, short_id):
+        """False if short_id is definitely not stored, True if the database has to be asked."""
+        self._builder.ensure_started()
+        if self._filter is None:
+            return True
+        if short_id not in self._filter:
+            self.sync(if_changed=True)
+            if short_id not in self._filter:
+                self.filtered += 1
+                return False
+        self.passed += 1
+        return True
+
+    def record_false_positive(self):
+        """The database did not know a short ID the filter let through."""
+        if self._filter is not None:
+            self.false_positives += 1
+
+    def add(self, short_id):
+        """Add a short ID created by this process."""
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(short_id)
+
+    def record_deletions(self, count=1):
+        """A Bloom filter can't remove keys, deletions are counted to trigger an early rebuild."""
+        self._deleted += count
+
+    def sync(self, if_changed=False):
+        """Add rows stored by other processes since the last sync. with if_changed, only if the database was
+            written since then"""
+        with self._lock:
+            if self._filter is None:
+                return
+            # taken before reading, writes committed while reading change it again
+            version = self.version_fn()
+            if if_changed and version is not None and version == self._version:
+                return
+            self.__add_rows_after(self._filter, self._watermarks)
+            self._version = version
+            self.syncs += 1
+
+    def rebuild(self):
+        """Build a new filter from all stored short IDs and swap it in."""
+        with self._rebuild_lock:
+            count = self.count_fn()
+            bloom = BloomFilter(max(self.min_capacity, 2 * count), self.fp_rate, self.max_bytes)
+            watermarks = [0] * self.shards
+            self.__add_rows_after(bloom, watermarks)
+            with self._lock:
+                # rows committed while building (including this process's creates) are in the database by now
+                version = self.version_fn()
+                self.__add_rows_after(bloom, watermarks)
+                self._filter, self._watermarks, self._version = bloom, watermarks, version
+                self._built_at = time.monotonic()
+                self._deleted = 0
+                self.builds += 1
+
+    def stats(self):
+        bloom = self._filter
+        return {
+            "ready": bloom is not None,
+            "entries": bloom.entries if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "bytes": bloom.bytes if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "expected_fp_rate": bloom.expected_fp_rate() if bloom else None,
+            "filtered": self.filtered,
+            "passed": self.passed,
+            "false_positives": self.false_positives,
+            "syncs": self.syncs,
+            "builds": self.builds,
+            "build_failures": self.build_failures,
+        }
+
+    def __add_rows_after(self, bloom, watermarks):
+        for shard, row_id, short_id in self.rows_after_fn(list(watermarks)):
+            bloom.add(short_id)
+            watermarks[shard] = max(watermarks[shard], row_id)
+
+    def __needs_rebuild(self):
+        bloom = self._filter
+        return (bloom is None or time.monotonic() - self._built_at >= self.rebuild_interval
+                or bloom.entries > bloom.capacity or self._deleted > BLOOM_REBUILD_DELETED_RATIO * bloom.entries)
+
+    def __run(self):
+        while True:
+            try:
+                if self.__needs_rebuild():
+                    self.rebuild()
+            except Exception:
+                self.build_failures += 1
+                logger.exception("short ID filter build failed, retrying later")
+            time.sleep(5)
@@ -0,0 +1,264 @@
+"""Streams url_mappings in from and out to CSV or JSON Lines files, in constant memory.
+
+    python -m url_shortener_service.bulk import links.csv --owner alice
+    python -m url_shortener_service.bulk import links.jsonl --checkpoint links.ckpt --errors links.rejected.jsonl
+    python -m url_shortener_service.bulk export mappings.jsonl --checkpoint mappings.ckpt
+
+Import records are URL strings (JSON Lines) or rows/objects with a 'url' (or 'value', 'original_url', or the column
+given with --url-field) and optional 'short_id', 'owner' and 'access_count' fields; CSV files need a header line.
+Records without a short_id get a generated one, records whose short_id is taken or whose URL is invalid are
+counted as failed (and written to --errors). Every --batch-size records are inserted with one transaction per shard.
+
+With --checkpoint, the position after every committed batch is saved and a rerun with the same checkpoint file
+continues from there. Should the process die between a commit and the checkpoint write, that one batch is imported
+again: its custom short IDs fail as taken, its generated ones are created a second time.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+from url_shortener_service.database import create_table, import_url_mappings, iter_url_mappings
+from url_shortener_service.utils import regex_validation
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 10000))
+EXPORT_FIELDS = ("short_id", "original_url", "owner", "access_count")
+URL_FIELDS = ("url", "value", "original_url")
+
+def __format_of(path, format):
+    if format:
+        return format
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def __load_checkpoint(path, kind, file_path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("kind") != kind or checkpoint.get("file") != os.path.abspath(file_path):
+        raise ValueError(f"checkpoint {path} belongs to the {checkpoint.get('kind')} of {checkpoint.get('file')}")
+    return checkpoint
+
+def __save_checkpoint(path, checkpoint):
+    """Replace the checkpoint file atomically, a crash leaves either the old or the new one."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def __read_lines(f, position):
+    """Decoded lines of a binary file, position[0] is the byte offset after the last line handed out."""
+    for line in f:
+        position[0] += len(line)
+        yield line.decode("utf-8")
+
+def __iter_records(f, format, offset):
+    """Yield (record number, byte offset after the record, record) from offset on. CSV rows are dicts by header,
+        JSON Lines records whatever the line holds"""
+    header = None
+    if format == "csv":
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode("utf-8-sig")]), None)
+        if not header:
+            return
+        offset = max(offset, len(header_line))
+    f.seek(offset)
+    position = [offset]
+    lines = __read_lines(f, position)
+    if format == "csv":
+        for number, row in enumerate(csv.reader(lines), 1):
+            if row:
+                yield number, position[0], dict(zip(header, row))
+    else:
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if line:
+                try:
+                    yield number, position[0], json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield number, position[0], e
+
+def __parse(record, url_field, default_owner):
+    """Return (custom_short_id or None, url, owner, access_count), or raise ValueError with the reason."""
+    if isinstance(record, Exception):
+        raise ValueError(f"Invalid JSON: {record}")
+    if isinstance(record, str):
+        record = {"url": record}
+    if not isinstance(record, dict):
+        raise ValueError("Expected a URL string or an object")
+    fields = (url_field,) if url_field else URL_FIELDS
+    url = next((record[field] for field in fields if record.get(field)), None)
+    if not url:
+        raise ValueError("Missing 'url' or 'value' field")
+    if not isinstance(url, str) or regex_validation(url):
+        raise ValueError("Invalid URL format")
+    owner = record.get("owner") or default_owner
+    if not owner:
+        raise ValueError("Missing 'owner', pass --owner")
+    if not isinstance(owner, str):
+        raise ValueError("Invalid owner")
+    short_id = record.get("short_id") or None
+    if short_id is not None and not isinstance(short_id, str):
+        raise ValueError("Invalid short_id")
+    access_count = record.get("access_count") or 0
+    # JSON booleans are ints, CSV fields are strings
+    if isinstance(access_count, bool) or not isinstance(access_count, (int, str)):
+        raise ValueError("Invalid access_count")
+    try:
+        access_count = int(access_count)
+    except ValueError:
+        raise ValueError("Invalid access_count")
+    return short_id, url, owner, access_count
+
+def import_file(path, format=None, owner=None, url_field=None, batch_size=BULK_BATCH_SIZE, checkpoint_path=None,
+                errors_path=None, log=print):
+    """Import a CSV or JSON Lines file, returns (imported, failed) counts including earlier resumed runs."""
+    format = __format_of(path, format)
+    checkpoint = __load_checkpoint(checkpoint_path, "import", path) or {
+        "kind": "import", "file": os.path.abspath(path), "offset": 0, "records": 0, "imported": 0, "failed": 0}
+    if checkpoint["offset"]:
+        log(f"resuming {path} at byte {checkpoint['offset']} after {checkpoint['records']} records")
+    size = os.path.getsize(path)
+    errors = open(errors_path, "a", encoding="utf-8") if errors_path else None
+    start = time.perf_counter()
+    imported_before = checkpoint["imported"] + checkpoint["failed"]
+
+    def commit(batch, offset, records):
+        if batch:
+            short_ids = import_url_mappings([item for _, item in batch])
+            for (number, item), short_id in zip(batch, short_ids):
+                if short_id:
+                    checkpoint["imported"] += 1
+                else:
+                    reject(number, "Short ID already in use", {"short_id": item[0], "url": item[1]})
+            batch.clear()
+        checkpoint["offset"], checkpoint["records"] = offset, records
+        if errors:
+            errors.flush()
+        if checkpoint_path:
+            __save_checkpoint(checkpoint_path, checkpoint)
+        done = checkpoint["imported"] + checkpoint["failed"] - imported_before
+        log(f"{checkpoint['records']} records, {checkpoint['imported']} imported, {checkpoint['failed']} failed, "
+            f"{100 * offset / size if size else 100:.1f}% ({done / (time.perf_counter() - start):.0f}/s)")
+
+    def reject(number, error, record):
+        checkpoint["failed"] += 1
+        if errors:
+            errors.write(json.dumps({"record": number, "error": error, "value": record}) + "\n")
+
+    try:
+        with open(path, "rb") as f:
+            batch = []
+            offset, records = checkpoint["offset"], checkpoint["records"]
+            records_before = records
+            for number, offset, record in __iter_records(f, format, checkpoint["offset"]):
+                records = records_before + number
+                try:
+                    batch.append((records, __parse(record, url_field, owner)))
+                except ValueError as e:
+                    reject(records, str(e), record if not isinstance(record, Exception) else None)
+                if len(batch) >= batch_size:
+                    commit(batch, offset, records)
+            commit(batch, offset, records)
+    finally:
+        if errors:
+            errors.close()
+    return checkpoint["imported"], checkpoint["failed"]
+
+def export_file(path, format=None, chunk_size=BULK_BATCH_SIZE, checkpoint_path=None, log=print):
+    """Export all mappings to a CSV or JSON Lines file ("-" for stdout), returns the number of rows written."""
+    format = __format_of(path, format)
+    to_stdout = path == "-"
+    if to_stdout and checkpoint_path:
+        raise ValueError("--checkpoint needs an output file")
+    checkpoint = __load_checkpoint(checkpoint_path, "export", path) or {
+        "kind": "export", "file": os.path.abspath(path), "after": 0, "offset": 0, "rows": 0}
+    start = time.perf_counter()
+    exported_before = checkpoint["rows"]
+
+    if to_stdout:
+        out = sys.stdout.buffer
+    else:
+        # drop whatever was written after the last checkpoint
+        out = open(path, "r+b" if checkpoint["offset"] else "wb")
+        out.seek(checkpoint["offset"])
+        out.truncate()
+    try:
+        if checkpoint["offset"]:
+            log(f"resuming {path} after {checkpoint['rows']} rows")
+        elif format == "csv":
+            out.write(",".join(EXPORT_FIELDS).encode("utf-8") + b"\r\n")
+
+        def flush(after, buffer):
+            out.write(buffer.getvalue().encode("utf-8"))
+            out.flush()
+            checkpoint["after"] = after
+            checkpoint["offset"] = out.tell() if not to_stdout else 0
+            if checkpoint_path:
+                os.fsync(out.fileno())
+                __save_checkpoint(checkpoint_path, checkpoint)
+            done = checkpoint["rows"] - exported_before
+            log(f"{checkpoint['rows']} rows exported ({done / (time.perf_counter() - start):.0f}/s)")
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        pending = 0
+        after = checkpoint["after"]
+        for after, row in iter_url_mappings(checkpoint["after"], chunk_size):
+            values = [row[field] for field in EXPORT_FIELDS]
+            if format == "csv":
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + "\n")
+            checkpoint["rows"] += 1
+            pending += 1
+            if pending >= chunk_size:
+                flush(after, buffer)
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        flush(after, buffer)
+    finally:
+        if not to_stdout:
+            out.close()
+    return checkpoint["rows"]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="insert the records of a CSV or JSON Lines file")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--owner", help="owner of records without an 'owner' field")
+    import_parser.add_argument("--url-field", help="field or CSV column holding the URL")
+    import_parser.add_argument("--errors", help="append failed records to this JSON Lines file")
+    export_parser = commands.add_parser("export", help="write all mappings to a CSV or JSON Lines file")
+    export_parser.add_argument("file", help='output file, "-" for stdout')
+    for command in (import_parser, export_parser):
+        command.add_argument("--format", choices=("csv", "jsonl"), help="default: by file extension, else jsonl")
+        command.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="records per transaction/chunk")
+        command.add_argument("--checkpoint", help="progress file to resume from and update after every batch")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be positive")
+    # progress goes to stderr, stdout may carry the export
+    log = lambda message: print(message, file=sys.stderr)
+
+    try:
+        if args.command == "import":
+            create_table()
+            imported, failed = import_file(args.file, args.format, args.owner, args.url_field, args.batch_size,
+                                           args.checkpoint, args.errors, log)
+            log(f"{imported} mappings imported, {failed} records failed")
+        else:
+            rows = export_file(args.file, args.format, args.batch_size, args.checkpoint, log)
+            log(f"{rows} mappings exported")
+    except (FileNotFoundError, ValueError) as e:
+        sys.exit(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import logging
+import time
+import os
+from url_shortener_service.background import ProcessThread
+from url_shortener_service.click_buffer import ClickBuffer
+
+logger = logging.getLogger(__name__)
+
+# per-link click time series settings, durations in seconds
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "true").lower() == "true"
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 1.0))
+ANALYTICS_MAX_BUFFERED_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUFFERED_BUCKETS", 10000))
+ANALYTICS_ROLLUP_INTERVAL = float(os.getenv("ANALYTICS_ROLLUP_INTERVAL", 60))
+ANALYTICS_ROLLUP_GRACE = int(os.getenv("ANALYTICS_ROLLUP_GRACE", 300))  # how late buffered clicks may still arrive
+ANALYTICS_MINUTE_RETENTION = int(os.getenv("ANALYTICS_MINUTE_RETENTION", 2 * 86400))
+ANALYTICS_HOUR_RETENTION = int(os.getenv("ANALYTICS_HOUR_RETENTION", 90 * 86400))
+ANALYTICS_DAY_RETENTION = int(os.getenv("ANALYTICS_DAY_RETENTION", 0))  # 0 keeps day buckets forever
+
+# bucket widths in seconds, the finest one is written, each coarser one is rolled up from the one before
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+RETENTION = {60: ANALYTICS_MINUTE_RETENTION, 3600: ANALYTICS_HOUR_RETENTION, 86400: ANALYTICS_DAY_RETENTION}
+ROLLUPS = ((60, 3600), (3600, 86400))
+
+def bucket_start(timestamp, granularity):
+    """Start (epoch seconds, UTC) of the bucket holding timestamp."""
+    timestamp = int(timestamp)
+    return timestamp - timestamp % granularity
+
+class ClickAnalytics:
+    """Time-bucketed click counts per short ID. record() only counts in memory, a ClickBuffer writes the minute
+        buckets in batches with write_fn({(short_id, minute_start): clicks}). a background thread calls
+        rollup_fn(now) every rollup_interval seconds, which compacts minute buckets into hour and day buckets and
+        prunes the ones past retention. clicks that were not written yet are lost if the process is killed"""
+
+    def __init__(self, write_fn, rollup_fn, flush_interval=ANALYTICS_FLUSH_INTERVAL,
+                 max_buckets=ANALYTICS_MAX_BUFFERED_BUCKETS, rollup_interval=ANALYTICS_ROLLUP_INTERVAL):
+        self.rollup_fn = rollup_fn
+        self.rollup_interval = rollup_interval
+        self._buffer = ClickBuffer(write_fn, flush_interval, max_buckets)
+        self._roller = ProcessThread(self.__run, "click-analytics-rollup")
+        self.recorded = 0
+        self.rollups = 0
+        self.rolled_up = 0
+        self.pruned = 0
+        self.rollup_failures = 0
+        self.rollup_seconds = 0.0
+
+    def record(self, short_id, timestamp=None):
+        """Count one click of short_id at timestamp (now by default)."""
+        self._roller.ensure_started()
+        self._buffer.record((short_id, bucket_start(time.time() if timestamp is None else timestamp, 60)))
+        self.recorded += 1
+
+    def flush(self):
+        """Write the buffered buckets right away."""
+        self._buffer.flush()
+
+    def rollup(self, now=None):
+        """Flush, then roll up and prune, returns (rolled up, pruned) bucket counts."""
+        self.flush()
+        start = time.perf_counter()
+        rolled_up, pruned = self.rollup_fn(time.time() if now is None else now)
+        self.rollup_seconds = time.perf_counter() - start
+        self.rolled_up += rolled_up
+        self.pruned += pruned
+        self.rollups += 1
+        return rolled_up, pruned
+
+    def stats(self):
+        return {
+            "pending_buckets": self._buffer.pending_keys(),
+            "recorded": self.recorded,
+            "rollups": self.rollups,
+            "rolled_up": self.rolled_up,
+            "pruned": self.pruned,
+            "rollup_failures": self.rollup_failures,
+            "write_failures": self._buffer.flush_failures,
+            "rollup_seconds": self.rollup_seconds,
+        }
+
+    def __run(self):
+        while True:
+            time.sleep(self.rollup_interval)
+            try:
+                self.rollup()
+            except Exception:
+                self.rollup_failures += 1
+                logger.exception("click analytics rollup failed, retrying later")
@@ -0,0 +1,87 @@
+import logging
+import threading
+import atexit
+import os
+from url_shortener_service.background import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# write-behind click counting settings
+CLICK_BUFFER_ENABLED = os.getenv("CLICK_BUFFER_ENABLED", "true").lower() == "true"
+CLICK_FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", 1.0))  # seconds
+CLICK_MAX_BUFFERED_KEYS = int(os.getenv("CLICK_MAX_BUFFERED_KEYS", 1000))
+
+class ClickBuffer:
+    """Accumulates access_count increments in memory and hands them to flush_fn as one {short_id: delta} batch.
+        a flush is triggered every flush_interval seconds, as soon as max_keys distinct ids are buffered and on exit.
+        increments that were not flushed yet are lost if the process is killed"""
+
+    def __init__(self, flush_fn, flush_interval=CLICK_FLUSH_INTERVAL, max_keys=CLICK_MAX_BUFFERED_KEYS):
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._counts = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = ProcessThread(self.__run, "click-buffer-flusher")
+        self.flush_failures = 0
+        atexit.register(self.flush)
+
+    def record(self, short_id):
+        """Count one access of short_id."""
+        self._flusher.ensure_started()
+        with self._lock:
+            self._counts[short_id] = self._counts.get(short_id, 0) + 1
+            full = len(self._counts) >= self.max_keys
+        if full:
+            self._wakeup.set()
+
+    def pending(self, short_id):
+        """Number of accesses of short_id that are not yet written to the database."""
+        with self._lock:
+            return self._counts.get(short_id, 0) + self._flushing.get(short_id, 0)
+
+    def pending_keys(self):
+        """Number of distinct short IDs with buffered accesses."""
+        with self._lock:
+            return len(self._counts)
+
+    def hold(self):
+        """Lock that keeps flushes out, so a database read plus pending() neither misses nor double counts a batch."""
+        return self._flush_lock
+
+    def discard(self, short_id):
+        """Drop buffered accesses of a mapping that no longer exists."""
+        with self._lock:
+            self._counts.pop(short_id, None)
+
+    def flush(self):
+        """Write all buffered increments in one batch. on failure they are merged back for the next attempt."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._counts:
+                    return
+                batch, self._counts = self._counts, {}
+                self._flushing = batch
+            try:
+                self.flush_fn(batch)
+            except Exception:
+                with self._lock:
+                    for short_id, delta in batch.items():
+                        self._counts[short_id] = self._counts.get(short_id, 0) + delta
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def __run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.flush_failures += 1
+                logger.exception("click buffer flush failed, retrying later")
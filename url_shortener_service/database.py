@@ -1,38 +1,136 @@
 import sqlite3
+import heapq
+import itertools
+import queue
+import time
 import os
+from url_shortener_service.click_buffer import ClickBuffer, CLICK_BUFFER_ENABLED
+from url_shortener_service.click_analytics import (ClickAnalytics, ANALYTICS_ENABLED, ANALYTICS_ROLLUP_INTERVAL,
+                                                   ANALYTICS_ROLLUP_GRACE, RETENTION, ROLLUPS, bucket_start)
+from url_shortener_service.url_cache import LRUCache, URL_CACHE_SHARED_SLOTS
+from url_shortener_service.bloom_filter import ShortIdFilter, BLOOM_FILTER_ENABLED
+from url_shortener_service.redirect_snapshot import RedirectSnapshot, REDIRECT_SNAPSHOT_ENABLED, REDIRECT_SNAPSHOT_PATH
+from url_shortener_service.id_allocator import IdAllocator, ID_ALLOCATOR
+from url_shortener_service.utils import base62_encode, generate_short_id
+from url_shortener_service.metrics import TimedConnection, registry, gauge, stats_collector
+from url_shortener_service.sharding import shard_for, shard_paths, list_key, shard_after
 
 DB_MOUNT_POINT = os.getenv("DB_MOUNT_POINT", "/var/data")
 DB_NAME = os.getenv("DB_NAME_SHORTENER", "urls.db")
 DATABASE_URL = f"sqlite:///{DB_MOUNT_POINT}/{DB_NAME}"
 
-def __get_db_connection():
-    """Establish a connection to the database."""
-    db_path = DATABASE_URL.replace("sqlite:///", "")
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row    
-    __def_user_functions(conn)  # Assuming this function exists
+# url_mappings is partitioned by a hash of short_id over DB_SHARDS database files, each with its own write lock.
+# the ID sequence lives in shard 0. change the shard count of existing data with url_shortener_service.reshard
+DB_SHARDS = int(os.getenv("DB_SHARDS", 1))
+DB_SHARD_PATHS = shard_paths(DB_MOUNT_POINT, DB_NAME, DB_SHARDS)
+
+# connection pool & pragma settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 268435456))  # bytes
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", -16000))   # pages, or KiB when negative
+
+SQL_MAX_VARIABLES = 500  # bound parameters per IN (...) query
+LIST_CHUNK_SIZE = int(os.getenv("LIST_CHUNK_SIZE", 1000))  # rows fetched per step when streaming listings
+FILE_STAMP_GRANULARITY_NS = 50_000_000  # file modification times are only as precise as the kernel's coarse clock
+
+# "sql" puts the owner predicate into the UPDATE/DELETE statements, "trigger" uses the per-row ownership triggers
+AUTHZ_MODE = os.getenv("AUTHZ_MODE", "sql").lower()
+ERROR_FORBIDDEN = "Forbidden : User does not own this mapping"
+IMPORT_USER = {"name": "import", "admin": True}  # executing user of bulk imports
+
+__pools = [queue.LifoQueue(maxsize=DB_POOL_SIZE) for _ in range(DB_SHARDS)]
+
+class ForbiddenError(sqlite3.IntegrityError):
+    """User tried to change a mapping they don't own. subclasses IntegrityError like the trigger's RAISE(ABORT)"""
+
+class PooledConnection(TimedConnection):
+    """sqlite3 connection that is kept open between requests. close() hands it back to the pool,
+        user_info holds the executing user for the is_admin/executing_user functions"""
+    user_info = None
+    pooled = False
+    shard = 0
+
+    def close(self):
+        release_db_connection(self)
+
+def __open_db_connection(shard):
+    """Open a new connection to a shard and apply the configured pragmas (done once per pooled connection)."""
+    conn = sqlite3.connect(DB_SHARD_PATHS[shard], timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, factory=PooledConnection)
+    conn.shard = shard
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+    __def_user_functions(conn)
+    return conn
+
+def __get_db_connection(shard=0):
+    """Take an idle connection to a shard from its pool, opening a new one if none is available."""
+    try:
+        conn = __pools[shard].get_nowait()
+    except queue.Empty:
+        conn = __open_db_connection(shard)
+    conn.pooled = False
+    conn.user_info = None
     return conn
 
-def __def_user_functions(conn, user_info=None):
-    """Define/replace conn-scoped functions for user priveleges on row. if no user_info specified then
-        admin role is assumed"""
+def release_db_connection(conn):
+    """Return a connection to the pool. Open transactions are rolled back, connections beyond
+        DB_POOL_SIZE are closed for real"""
+    if conn.pooled:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    conn.user_info = None
+    conn.pooled = True
+    try:
+        __pools[conn.shard].put_nowait(conn)
+    except queue.Full:
+        sqlite3.Connection.close(conn)
+
+def close_db_connections():
+    """Close all idle pooled connections, e.g. in a pre-fork master before its workers are forked."""
+    for pool in __pools:
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            sqlite3.Connection.close(conn)
+
+def __def_user_functions(conn):
+    """Define conn-scoped functions for user priveleges on row. they read the user bound to the connection,
+        if no user_info is bound then admin role is assumed"""
     def is_current_user_admin():
-        return (True if not user_info else user_info["admin"])
+        return (True if not conn.user_info else conn.user_info["admin"])
     def get_current_user():
-        return (None if not user_info else user_info["name"])
+        return (None if not conn.user_info else conn.user_info["name"])
     
     conn.create_function("is_admin",0, is_current_user_admin)
     conn.create_function("executing_user",0, get_current_user)
 
-def get_db_connection_user(user_info):
+def __shard_of(short_id):
+    return shard_for(short_id, DB_SHARDS)
+
+def get_db_connection_user(user_info, shard=0):
     """Establish a connection to the database with update/delete restrictions based on user"""
-    conn = __get_db_connection()
-    __def_user_functions(conn, user_info)
+    conn = __get_db_connection(shard)
+    conn.user_info = user_info
     return conn
 
 def create_table():
-    """Create the table if it does not exist."""
-    conn = __get_db_connection()
+    """Create the tables of every shard if they do not exist."""
+    for shard in range(DB_SHARDS):
+        __create_shard_tables(shard)
+
+def __create_shard_tables(shard):
+    conn = __get_db_connection(shard)
     cursor = conn.cursor()
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS url_mappings (
@@ -44,88 +142,579 @@ def create_table():
     )
     """)
 
-    # create triggers for restricted update/delete user-privelege on rows in url_mappings table
+    # keyset listing of a user's mappings
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_url_mappings_owner ON url_mappings (owner, id)")
+
+    # click time series, one row per short ID and bucket; granularity is the bucket width in seconds
     cursor.execute("""
-        CREATE TRIGGER IF NOT EXISTS validate_user_before_mapping_update
-        BEFORE UPDATE ON url_mappings
-            WHEN NOT is_admin() AND OLD.owner <> executing_user() 
-        BEGIN 
-            SELECT RAISE(ABORT,'Forbidden : User does not own this mapping');
-        END;
+    CREATE TABLE IF NOT EXISTS click_buckets (
+        short_id TEXT NOT NULL,
+        granularity INTEGER NOT NULL,
+        bucket_start INTEGER NOT NULL,  -- epoch seconds, UTC
+        clicks INTEGER NOT NULL,
+        PRIMARY KEY (short_id, granularity, bucket_start)
+    ) WITHOUT ROWID
     """)
+    # rollups and pruning scan one granularity by time
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_click_buckets_time ON click_buckets (granularity, bucket_start)")
+    # how far each coarser granularity was rolled up
     cursor.execute("""
-        CREATE TRIGGER IF NOT EXISTS validate_user_before_mapping_deletion
-        BEFORE DELETE ON url_mappings
-            WHEN NOT is_admin() AND OLD.owner <> executing_user() 
-        BEGIN 
-            SELECT RAISE(ABORT,'Forbidden : User does not own this mapping');
-        END;
+    CREATE TABLE IF NOT EXISTS click_rollups (
+        granularity INTEGER PRIMARY KEY,
+        rolled_up_to INTEGER NOT NULL
+    )
     """)
 
+    if shard == 0:
+        # sequence numbers for short ID allocation, leased in blocks by each worker
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS id_sequence (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        )
+        """)
+        cursor.execute("INSERT OR IGNORE INTO id_sequence (name, next_value) VALUES ('short_id', 0)")
+
+    if AUTHZ_MODE == "trigger":
+        # create triggers for restricted update/delete user-privelege on rows in url_mappings table
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS validate_user_before_mapping_update
+            BEFORE UPDATE ON url_mappings
+                WHEN NOT is_admin() AND OLD.owner <> executing_user() 
+            BEGIN 
+                SELECT RAISE(ABORT,'Forbidden : User does not own this mapping');
+            END;
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS validate_user_before_mapping_deletion
+            BEFORE DELETE ON url_mappings
+                WHEN NOT is_admin() AND OLD.owner <> executing_user() 
+            BEGIN 
+                SELECT RAISE(ABORT,'Forbidden : User does not own this mapping');
+            END;
+        """)
+    else:
+        # ownership is checked in the statements themselves, the triggers would call back into python per row
+        cursor.execute("DROP TRIGGER IF EXISTS validate_user_before_mapping_update")
+        cursor.execute("DROP TRIGGER IF EXISTS validate_user_before_mapping_deletion")
+
     conn.commit()
     conn.close()
 
+def lease_id_block(size):
+    """Atomically reserve `size` sequence numbers and return the first one."""
+    conn = __get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE id_sequence SET next_value = next_value + ? WHERE name = 'short_id'", (size,))
+        cursor.execute("SELECT next_value FROM id_sequence WHERE name = 'short_id'")
+        start = cursor.fetchone()["next_value"] - size
+        conn.commit()
+        return start
+    finally:
+        conn.close()
+
+id_allocator = IdAllocator(lease_id_block, base62_encode)
+
+def allocate_short_id(url):
+    """Return a new short ID according to ID_ALLOCATOR."""
+    if ID_ALLOCATOR == "random":
+        return generate_short_id(url)
+    return id_allocator.next_id()
+
+def allocate_short_ids(urls):
+    """Return one new short ID per url, sequence IDs are leased in bulk."""
+    if ID_ALLOCATOR == "random":
+        return [generate_short_id(url) for url in urls]
+    return id_allocator.next_ids(len(urls))
+
+def __existing_short_ids(cursor, short_ids):
+    """Return the subset of short_ids that are already stored."""
+    short_ids = list(short_ids)
+    existing = set()
+    for i in range(0, len(short_ids), SQL_MAX_VARIABLES):
+        chunk = short_ids[i:i + SQL_MAX_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        cursor.execute(f"SELECT short_id FROM url_mappings WHERE short_id IN ({placeholders})", chunk)
+        existing.update(row["short_id"] for row in cursor.fetchall())
+    return existing
+
+def create_url_mappings(items, user_info):
+    """Create many URL mappings, in one transaction per shard. items is a list of (custom_short_id or None, original_url).
+        Returns a short_id per item, or None where the custom short_id is already in use (in the table or earlier in the batch)"""
+    return __insert_mappings([(short_id, url, user_info["name"], 0) for short_id, url in items], user_info)
+
+def import_url_mappings(items):
+    """Like create_url_mappings, for bulk imports that keep each mapping's owner and click count.
+        items is a list of (custom_short_id or None, original_url, owner, access_count)"""
+    return __insert_mappings(items, IMPORT_USER)
+
+def __insert_mappings(items, user_info):
+    # IDs are leased outside the shard transactions: leasing commits on another pooled connection to shard 0,
+    # which would wait for a transaction holding shard 0's write lock
+    generated = iter(allocate_short_ids([item[1] for item in items if not item[0]]))
+    candidates = [item[0] or next(generated) for item in items]
+    short_ids = [None] * len(items)
+    pending = range(len(items))
+    seen = set()
+    while pending:
+        # generated IDs that clash with a custom, legacy or earlier ID are replaced in the next round
+        retry = []
+        by_shard = {}
+        # custom IDs first, a generated ID never takes one away
+        for i in sorted(pending, key=lambda i: not items[i][0]):
+            if candidates[i] in seen:
+                if not items[i][0]:
+                    retry.append(i)
+                continue
+            seen.add(candidates[i])
+            by_shard.setdefault(__shard_of(candidates[i]), []).append(i)
+
+        for shard, indices in by_shard.items():
+            conn = get_db_connection_user(user_info, shard)
+            try:
+                cursor = conn.cursor()
+                # take the write lock up front so the existence check and the insert see the same table
+                cursor.execute("BEGIN IMMEDIATE")
+                taken = __existing_short_ids(cursor, [candidates[i] for i in indices])
+                rows = []
+                for i in indices:
+                    if candidates[i] not in taken:
+                        short_ids[i] = candidates[i]
+                        rows.append((candidates[i], *items[i][1:]))
+                    elif not items[i][0]:
+                        retry.append(i)
+                cursor.executemany("INSERT INTO url_mappings (short_id, original_url, owner, access_count) "
+                                   "VALUES (?, ?, ?, ?)", rows)
+                conn.commit()
+            finally:
+                conn.close()
+            if BLOOM_FILTER_ENABLED:
+                for row in rows:
+                    short_id_filter.add(row[0])
+
+        for i, short_id in zip(retry, allocate_short_ids([items[i][1] for i in retry])):
+            candidates[i] = short_id
+        pending = retry
+    return short_ids
+
 def create_url_mapping(short_id, original_url, user_info):
     """Create a new URL mapping. Returns True if successful, False if short_id already exists."""
+    conn = get_db_connection_user(user_info, __shard_of(short_id))
     try:
-        conn = get_db_connection_user(user_info)
         cursor = conn.cursor()
         cursor.execute("INSERT INTO url_mappings (short_id, original_url, owner) VALUES (?, ?, ?)", (short_id, original_url, user_info["name"]))
         conn.commit()
-        conn.close()
+        if BLOOM_FILTER_ENABLED:
+            short_id_filter.add(short_id)
         return True  
     except sqlite3.IntegrityError:
         return False  
+    finally:
+        conn.close()
 
-def get_original_url(short_id):
-    """Retrieve the original URL for a given short ID and update access count."""
-    conn = __get_db_connection()
-    cursor = conn.cursor()
+def __flush_clicks(deltas):
+    """Apply buffered access count increments in a single transaction per shard."""
+    by_shard = {}
+    for short_id, delta in deltas.items():
+        by_shard.setdefault(__shard_of(short_id), []).append((delta, short_id))
+    for shard, params in by_shard.items():
+        conn = __get_db_connection(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE url_mappings SET access_count = access_count + ? WHERE short_id = ?", params)
+            conn.commit()
+        finally:
+            conn.close()
 
-    # Retrieve the URL
-    cursor.execute("SELECT original_url FROM url_mappings WHERE short_id = ?", (short_id,))
-    result = cursor.fetchone()
+def __write_click_buckets(deltas):
+    """Add buffered minute buckets in a single transaction per shard, skipping short IDs deleted meanwhile."""
+    by_shard = {}
+    for (short_id, minute), clicks in deltas.items():
+        by_shard.setdefault(__shard_of(short_id), []).append((short_id, minute, clicks, short_id))
+    for shard, params in by_shard.items():
+        conn = __get_db_connection(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO click_buckets (short_id, granularity, bucket_start, clicks)
+                SELECT ?, 60, ?, ? WHERE EXISTS (SELECT 1 FROM url_mappings WHERE short_id = ?)
+                ON CONFLICT (short_id, granularity, bucket_start) DO UPDATE SET clicks = clicks + excluded.clicks
+            """, params)
+            conn.commit()
+        finally:
+            conn.close()
 
-    if result:
-        # Increment access count
-        cursor.execute("UPDATE url_mappings SET access_count = access_count + 1 WHERE short_id = ?", (short_id,))
+def __rollup_shard(shard, now):
+    """Recompute the coarser buckets a shard's new clicks fall into and prune expired buckets, in one transaction.
+        totals are replaced rather than added, so a rollup that runs twice (e.g. on two workers) changes nothing"""
+    rolled_up = pruned = 0
+    conn = __get_db_connection(shard)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for source, target in ROLLUPS:
+            cursor.execute("SELECT rolled_up_to FROM click_rollups WHERE granularity = ?", (target,))
+            row = cursor.fetchone()
+            if row and now - row["rolled_up_to"] < ANALYTICS_ROLLUP_INTERVAL / 2:
+                continue  # another worker just did it
+            # clicks arrive up to ANALYTICS_ROLLUP_GRACE seconds late, the buckets they can still change are redone
+            start = bucket_start(row["rolled_up_to"] - ANALYTICS_ROLLUP_GRACE, target) if row else 0
+            cursor.execute("""
+                INSERT INTO click_buckets (short_id, granularity, bucket_start, clicks)
+                SELECT short_id, ?, bucket_start - bucket_start % ?, SUM(clicks) FROM click_buckets
+                WHERE granularity = ? AND bucket_start >= ? GROUP BY short_id, bucket_start - bucket_start % ?
+                ON CONFLICT (short_id, granularity, bucket_start) DO UPDATE SET clicks = excluded.clicks
+            """, (target, target, source, start, target))
+            rolled_up += cursor.rowcount
+            cursor.execute("""
+                INSERT INTO click_rollups (granularity, rolled_up_to) VALUES (?, ?)
+                ON CONFLICT (granularity) DO UPDATE SET rolled_up_to = excluded.rolled_up_to
+            """, (target, now))
+            if RETENTION[source]:
+                # source buckets the next run recomputes from are kept whatever the retention
+                before = min(bucket_start(now - RETENTION[source], target), bucket_start(now - ANALYTICS_ROLLUP_GRACE, target))
+                cursor.execute("DELETE FROM click_buckets WHERE granularity = ? AND bucket_start < ?", (source, before))
+                pruned += cursor.rowcount
+        coarsest = ROLLUPS[-1][1]
+        if RETENTION[coarsest]:
+            cursor.execute("DELETE FROM click_buckets WHERE granularity = ? AND bucket_start < ?",
+                           (coarsest, bucket_start(now - RETENTION[coarsest], coarsest)))
+            pruned += cursor.rowcount
         conn.commit()
+    finally:
+        conn.close()
+    return rolled_up, pruned
+
+def __rollup_clicks(now):
+    rolled_up = pruned = 0
+    for shard in range(DB_SHARDS):
+        shard_rolled_up, shard_pruned = __rollup_shard(shard, int(now))
+        rolled_up += shard_rolled_up
+        pruned += shard_pruned
+    return rolled_up, pruned
+
+def __iter_shard_mappings(shard):
+    conn = __get_db_connection(shard)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT short_id, original_url FROM url_mappings ORDER BY short_id")
+        while True:
+            rows = cursor.fetchmany(LIST_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row["short_id"], row["original_url"]
+    finally:
+        conn.close()
 
+def iter_mappings_by_short_id():
+    """Yield (short_id, original_url) of all mappings in all shards, ordered by short_id."""
+    shard_rows = [__iter_shard_mappings(shard) for shard in range(DB_SHARDS)]
+    try:
+        yield from heapq.merge(*shard_rows) if DB_SHARDS > 1 else shard_rows[0]
+    finally:
+        for rows in shard_rows:
+            rows.close()
+
+def __iter_shard_mappings_after(shard, after, chunk_size):
+    """Yield (list key, row) of one shard's mappings after the cursor `after`, one short query per chunk so no read
+        transaction is held open between chunks"""
+    last_id = shard_after(after, shard, DB_SHARDS)
+    while True:
+        conn = __get_db_connection(shard)
+        try:
+            rows = conn.execute("SELECT id, short_id, original_url, owner, access_count FROM url_mappings "
+                                "WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size)).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            yield list_key(row["id"], shard, DB_SHARDS), row
+        if len(rows) < chunk_size:
+            break
+        last_id = rows[-1]["id"]
+
+def iter_url_mappings(after=0, chunk_size=LIST_CHUNK_SIZE):
+    """Yield (list key, row) of all mappings with a key > after, in list key order, e.g. for exports. rows have
+        short_id, original_url, owner and access_count"""
+    shard_rows = [__iter_shard_mappings_after(shard, after, chunk_size) for shard in range(DB_SHARDS)]
+    try:
+        yield from heapq.merge(*shard_rows, key=lambda item: item[0]) if DB_SHARDS > 1 else shard_rows[0]
+    finally:
+        for rows in shard_rows:
+            rows.close()
+
+def __count_mappings():
+    total = 0
+    for shard in range(DB_SHARDS):
+        conn = __get_db_connection(shard)
+        try:
+            total += conn.execute("SELECT COUNT(*) FROM url_mappings").fetchone()[0]
+        finally:
+            conn.close()
+    return total
+
+def __iter_rows_after(watermarks):
+    """Yield (shard, id, short_id) of the rows above each shard's watermark id."""
+    for shard in range(DB_SHARDS):
+        conn = __get_db_connection(shard)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, short_id FROM url_mappings WHERE id > ? ORDER BY id", (watermarks[shard],))
+            while True:
+                rows = cursor.fetchmany(LIST_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield shard, row["id"], row["short_id"]
+        finally:
+            conn.close()
+
+def __files_version():
+    """Modification time and size of the shard files (and their WAL), None while a write may be within the
+        file system's timestamp granularity, since a second write in the same tick would keep the same stamp."""
+    stamps = []
+    for path in DB_SHARD_PATHS:
+        for file_path in (path, f"{path}-wal"):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+    if not stamps or time.time_ns() - max(mtime for mtime, _ in stamps) < FILE_STAMP_GRANULARITY_NS:
+        return None
+    return tuple(stamps)
+
+click_buffer = ClickBuffer(__flush_clicks)
+click_analytics = ClickAnalytics(__write_click_buckets, __rollup_clicks)
+short_id_filter = ShortIdFilter(__count_mappings, __iter_rows_after, DB_SHARDS, __files_version)
+url_cache = LRUCache(shared_slots=URL_CACHE_SHARED_SLOTS)
+redirect_snapshot = RedirectSnapshot(iter_mappings_by_short_id, REDIRECT_SNAPSHOT_PATH or
+                                     os.path.join(DB_MOUNT_POINT, os.path.splitext(DB_NAME)[0] + ".snapshot"))
+
+def __collect_db_metrics():
+    return [
+        gauge("db_pool_idle_connections", "Idle pooled SQLite connections",
+              [({"shard": str(shard)}, pool.qsize()) for shard, pool in enumerate(__pools)]),
+        gauge("click_buffer_pending_keys", "Short IDs with clicks not yet flushed", [({}, click_buffer.pending_keys())]),
+        ("click_buffer_flush_failures_total", "counter", "Click buffer flushes that failed and were retried",
+         [({}, click_buffer.flush_failures)]),
+    ]
+
+registry.register_collector(__collect_db_metrics)
+registry.register_collector(stats_collector("url_cache", "Redirect cache", url_cache.stats,
+                                            ("hits", "misses", "evictions", "expirations", "invalidations")))
+registry.register_collector(stats_collector("short_id_filter", "Negative lookup Bloom filter", short_id_filter.stats,
+                                            ("filtered", "passed", "false_positives", "syncs", "builds",
+                                             "build_failures")))
+registry.register_collector(stats_collector("redirect_snapshot", "Memory-mapped redirect snapshot", redirect_snapshot.stats,
+                                            ("hits", "misses", "bypassed", "builds", "build_failures",
+                                             "load_failures")))
+registry.register_collector(stats_collector("click_analytics", "Click time series", click_analytics.stats,
+                                            ("recorded", "rollups", "rolled_up", "pruned", "rollup_failures",
+                                             "write_failures")))
+
+def __count_click(short_id):
+    """Increment the access count, either buffered or right away, and the click time series (always buffered)."""
+    if ANALYTICS_ENABLED:
+        click_analytics.record(short_id)
+    if CLICK_BUFFER_ENABLED:
+        click_buffer.record(short_id)
+        return
+    conn = __get_db_connection(__shard_of(short_id))
+    cursor = conn.cursor()
+    cursor.execute("UPDATE url_mappings SET access_count = access_count + 1 WHERE short_id = ?", (short_id,))
+    conn.commit()
     conn.close()
-    return result["original_url"] if result else None  
+
+def get_original_url(short_id):
+    """Retrieve the original URL for a given short ID (from the cache or the snapshot if possible) and update access count."""
+    original_url = url_cache.get(short_id)
+    cache_version = url_cache.version(short_id) if original_url is None else None
+    if original_url is None and BLOOM_FILTER_ENABLED and not short_id_filter.might_exist(short_id):
+        return None
+    if original_url is None and REDIRECT_SNAPSHOT_ENABLED:
+        original_url = redirect_snapshot.get(short_id)
+
+    if original_url is None:
+        conn = __get_db_connection(__shard_of(short_id))
+        cursor = conn.cursor()
+
+        # Retrieve the URL
+        cursor.execute("SELECT original_url FROM url_mappings WHERE short_id = ?", (short_id,))
+        result = cursor.fetchone()
+        conn.close()
+
+        if not result:
+            if BLOOM_FILTER_ENABLED:
+                short_id_filter.record_false_positive()
+            return None
+        original_url = result["original_url"]
+        url_cache.put(short_id, original_url, cache_version)
+
+    __count_click(short_id)
+    return original_url
+
+def __owner_clause(user_info):
+    """Owner predicate appended to UPDATE/DELETE statements in AUTHZ_MODE=sql, empty for admins and in trigger mode."""
+    if AUTHZ_MODE != "sql" or user_info.get("admin"):
+        return "", ()
+    return " AND owner = ?", (user_info["name"],)
+
+def __raise_if_exists(cursor, short_id):
+    """A statement restricted to the user's rows changed nothing: forbidden if the mapping exists, else not found."""
+    cursor.execute("SELECT 1 FROM url_mappings WHERE short_id = ?", (short_id,))
+    if cursor.fetchone():
+        raise ForbiddenError(ERROR_FORBIDDEN)
 
 def update_url_mapping(short_id, new_url, user_info):
-    """Update an existing short URL's mapping."""
+    """Update an existing short URL's mapping. Raises ForbiddenError if the user doesn't own it."""
     try:
-        conn = get_db_connection_user(user_info)
+        conn = get_db_connection_user(user_info, __shard_of(short_id))
         cursor = conn.cursor()
-        cursor.execute("UPDATE url_mappings SET original_url = ? WHERE short_id = ?", (new_url, short_id))
-        conn.commit()
+        owner_clause, owner_params = __owner_clause(user_info)
+        cursor.execute("UPDATE url_mappings SET original_url = ? WHERE short_id = ?" + owner_clause,
+                       (new_url, short_id) + owner_params)
         updated_rows = cursor.rowcount 
+        if updated_rows == 0 and owner_clause:
+            __raise_if_exists(cursor, short_id)
+        conn.commit()
+        url_cache.invalidate(short_id)
+        if REDIRECT_SNAPSHOT_ENABLED:
+            redirect_snapshot.invalidate(short_id)
         return updated_rows > 0
     finally:
         conn.close()
 
 def delete_url_mapping(short_id, user_info):
-    """Delete a URL mapping."""
+    """Delete a URL mapping. Raises ForbiddenError if the user doesn't own it."""
     try:
-        conn = get_db_connection_user(user_info)
+        conn = get_db_connection_user(user_info, __shard_of(short_id))
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM url_mappings WHERE short_id = ?", (short_id,))
-        conn.commit()
+        owner_clause, owner_params = __owner_clause(user_info)
+        cursor.execute("DELETE FROM url_mappings WHERE short_id = ?" + owner_clause, (short_id,) + owner_params)
         deleted_rows = cursor.rowcount  
+        if deleted_rows == 0 and owner_clause:
+            __raise_if_exists(cursor, short_id)
+        if deleted_rows > 0:
+            cursor.execute("DELETE FROM click_buckets WHERE short_id = ?", (short_id,))
+        conn.commit()
+        url_cache.invalidate(short_id)
+        if REDIRECT_SNAPSHOT_ENABLED:
+            redirect_snapshot.invalidate(short_id)
+        if deleted_rows > 0:
+            click_buffer.discard(short_id)
+            short_id_filter.record_deletions()
         return deleted_rows > 0
     finally:
         conn.close()
 
+def delete_all_url_mappings(user_info):
+    """Delete all mappings of the user (all mappings for admins) as one set operation per shard, returns the number
+        deleted. in trigger mode a non-admin's delete is aborted as soon as it reaches a row owned by someone else"""
+    deleted = 0
+    try:
+        for shard in range(DB_SHARDS):
+            conn = get_db_connection_user(user_info, shard)
+            try:
+                cursor = conn.cursor()
+                if AUTHZ_MODE == "sql" and not user_info.get("admin"):
+                    cursor.execute("DELETE FROM url_mappings WHERE owner = ?", (user_info["name"],))
+                else:
+                    cursor.execute("DELETE FROM url_mappings")
+                shard_deleted = cursor.rowcount
+                if shard_deleted:
+                    cursor.execute("DELETE FROM click_buckets WHERE short_id NOT IN (SELECT short_id FROM url_mappings)")
+                conn.commit()
+                deleted += shard_deleted
+                short_id_filter.record_deletions(shard_deleted)
+            finally:
+                conn.close()
+        return deleted
+    finally:
+        url_cache.clear()
+        if REDIRECT_SNAPSHOT_ENABLED:
+            redirect_snapshot.invalidate_all()
+
+def __list_query(user_info, after, limit):
+    """Keyset query over the caller's mappings (all mappings for admins) in one shard, ordered by id."""
+    if user_info.get("admin"):
+        sql, params = "SELECT id, short_id FROM url_mappings WHERE id > ? ORDER BY id", [after]
+    else:
+        sql, params = "SELECT id, short_id FROM url_mappings WHERE owner = ? AND id > ? ORDER BY id", [user_info["name"], after]
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def __iter_shard_rows(shard, user_info, after, limit, chunk_size):
+    """Yield (list key, short_id) of one shard's rows after the cursor `after`, holding the connection meanwhile."""
+    conn = __get_db_connection(shard)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(*__list_query(user_info, shard_after(after, shard, DB_SHARDS), limit))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield list_key(row["id"], shard, DB_SHARDS), row["short_id"]
+    finally:
+        conn.close()
+
+def __iter_rows(user_info, after, limit, chunk_size=LIST_CHUNK_SIZE):
+    """All shards' rows merged into one ordering by list key. closing it releases every shard's connection."""
+    shard_rows = [__iter_shard_rows(shard, user_info, after, limit, chunk_size) for shard in range(DB_SHARDS)]
+    try:
+        yield from heapq.merge(*shard_rows) if DB_SHARDS > 1 else shard_rows[0]
+    finally:
+        for rows in shard_rows:
+            rows.close()
+
+def list_short_ids(user_info, after=0, limit=100):
+    """Return one page of (list key, short_id) rows with a key > after. the key is the row id with a single shard."""
+    rows = __iter_rows(user_info, after, limit)
+    try:
+        return [row for _, row in zip(range(limit), rows)]
+    finally:
+        rows.close()
+
+def iter_short_id_chunks(user_info, after=0, chunk_size=LIST_CHUNK_SIZE):
+    """Yield lists of short_ids straight from the cursors, chunk_size rows at a time. the connections are held
+        until the generator is exhausted or closed"""
+    rows = __iter_rows(user_info, after, None, chunk_size)
+    try:
+        while True:
+            chunk = [short_id for _, short_id in itertools.islice(rows, chunk_size)]
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        rows.close()
+
 def get_link_stats(short_id):
-    """Retrieve the access count for a given short URL."""
-    conn = __get_db_connection()
+    """Retrieve the access count for a given short URL, including accesses still held in the click buffer."""
+    conn = __get_db_connection(__shard_of(short_id))
     cursor = conn.cursor()
-    cursor.execute("SELECT access_count FROM url_mappings WHERE short_id = ?", (short_id,))
-    result = cursor.fetchone()
+    with click_buffer.hold():
+        cursor.execute("SELECT access_count FROM url_mappings WHERE short_id = ?", (short_id,))
+        result = cursor.fetchone()
+        pending = click_buffer.pending(short_id)
     conn.close()
-    return result["access_count"] if result else None  # Return None if not found
+    return result["access_count"] + pending if result else None  # Return None if not found
 
-create_table()
+def get_click_series(short_id, start, end, granularity):
+    """Non-empty buckets of one granularity (width in seconds) starting in [start, end) as (bucket_start, clicks),
+        one range scan of the primary key. clicks still buffered by the workers are not included"""
+    conn = __get_db_connection(__shard_of(short_id))
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT bucket_start, clicks FROM click_buckets
+            WHERE short_id = ? AND granularity = ? AND bucket_start >= ? AND bucket_start < ? ORDER BY bucket_start
+        """, (short_id, granularity, bucket_start(start, granularity), end))
+        return [(row["bucket_start"], row["clicks"]) for row in cursor.fetchall()]
+    finally:
+        conn.close()
 
+create_table()
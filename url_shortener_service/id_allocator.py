@@ -0,0 +1,76 @@
+import threading
+import hashlib
+import os
+
+# short ID allocation settings
+ID_ALLOCATOR = os.getenv("ID_ALLOCATOR", "sequence").lower()  # "sequence" or "random" (hash based, legacy)
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", 1000))  # sequence numbers leased from the database at once
+ID_LENGTH = int(os.getenv("ID_LENGTH", 7))
+ID_SCRAMBLE = os.getenv("ID_SCRAMBLE", "true").lower() == "true"
+ID_SCRAMBLE_KEY = os.getenv("ID_SCRAMBLE_KEY", os.getenv("JWT_SECRET_KEY", "kube-url-shortener"))
+
+FEISTEL_ROUNDS = 4
+
+def permute(num, key, domain):
+    """Reversible keyed permutation of [0, domain): a balanced Feistel network over the next even bit width,
+        cycle-walking until the result falls inside the domain"""
+    bits = (domain - 1).bit_length()
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+    while True:
+        left, right = num >> half, num & mask
+        for round in range(FEISTEL_ROUNDS):
+            digest = hashlib.blake2b(f"{round}:{right}".encode(), key=key, digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+        num = (left << half) | right
+        if num < domain:
+            return num
+
+class IdAllocator:
+    """Hands out short IDs from blocks of sequence numbers leased from the database, so IDs never collide
+        with each other and need no lookup. lease_fn(size) must atomically reserve `size` numbers and return the first.
+        numbers left in a block are skipped when the process exits"""
+
+    def __init__(self, lease_fn, encode_fn, block_size=ID_BLOCK_SIZE, length=ID_LENGTH, scramble=ID_SCRAMBLE,
+                 scramble_key=ID_SCRAMBLE_KEY):
+        self.lease_fn = lease_fn
+        self.encode_fn = encode_fn
+        self.block_size = block_size
+        self.length = length
+        self.scramble = scramble
+        self.scramble_key = hashlib.sha256(scramble_key.encode("utf-8")).digest()
+        self.domain = 62 ** length
+        self._next = 0
+        self._end = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def next_ids(self, count=1):
+        """Allocate `count` sequence numbers, leasing new blocks when needed, and return their encoded IDs."""
+        numbers = []
+        with self._lock:
+            # a forked worker must not reuse the block of its parent
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._next = self._end = 0
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    size = max(self.block_size, count - len(numbers))
+                    self._next = self.lease_fn(size)
+                    self._end = self._next + size
+                take = min(count - len(numbers), self._end - self._next)
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+        return [self.encode(number) for number in numbers]
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+    def encode(self, number):
+        """Encode a sequence number. scrambled IDs are exactly `length` chars, plain ones at least `length` chars."""
+        if self.scramble:
+            if number >= self.domain:
+                raise ValueError(f"ID space of {self.length} characters is exhausted, increase ID_LENGTH")
+            return self.encode_fn(permute(number, self.scramble_key, self.domain)).rjust(self.length, "0")
+        return self.encode_fn(number + 62 ** (self.length - 1))
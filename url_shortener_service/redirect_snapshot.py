@@ -0,0 +1,233 @@
+import logging
+import threading
+import struct
+import fcntl
+import array
+import mmap
+import time
+import sys
+import os
+from url_shortener_service.background import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# read-only redirect snapshot settings
+REDIRECT_SNAPSHOT_ENABLED = os.getenv("REDIRECT_SNAPSHOT_ENABLED", "false").lower() == "true"
+REDIRECT_SNAPSHOT_PATH = os.getenv("REDIRECT_SNAPSHOT_PATH")  # default: <DB_MOUNT_POINT>/<db name>.snapshot
+REDIRECT_SNAPSHOT_INTERVAL = float(os.getenv("REDIRECT_SNAPSHOT_INTERVAL", 60))  # seconds between rebuilds
+REDIRECT_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("REDIRECT_SNAPSHOT_CHECK_INTERVAL", 5))  # seconds between file checks
+
+# file layout: header, then per mapping (key length u16, url length u32, key, url) sorted by key bytes,
+# then an array of count + 1 u64 entry offsets (the last one marks the end of the entries)
+MAGIC = b"USNAP1" + (b"LE" if sys.byteorder == "little" else b"BE")
+HEADER = struct.Struct("<8sQQdd")  # magic, count, index offset, built at (unix time), build seconds
+ENTRY_HEADER = struct.Struct("<HI")
+
+class _SnapshotFile:
+    """One mapped snapshot file. the offsets are a view into the mapping, nothing is copied on load"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, index_offset, self.built_at, self.build_seconds = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a redirect snapshot of this platform")
+        self.offsets = memoryview(self.mm)[index_offset:index_offset + 8 * (self.count + 1)].cast("Q")
+        self.size = stat.st_size
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+
+    def get(self, key):
+        """Binary search for the key bytes, returns the original URL or None."""
+        mm, offsets = self.mm, self.offsets
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = offsets[mid]
+            start = offset + ENTRY_HEADER.size
+            # little-endian u16 key length, read without unpacking the entry header
+            if mm[start:start + (mm[offset] | mm[offset + 1] << 8)] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        key_length, url_length = ENTRY_HEADER.unpack_from(mm, offsets[lo])
+        start = offsets[lo] + ENTRY_HEADER.size
+        if mm[start:start + key_length] != key:
+            return None
+        return mm[start + key_length:start + key_length + url_length].decode("utf-8")
+
+def write_snapshot(path, rows):
+    """Write (short_id, original_url) rows, which must be sorted by short_id, into a new snapshot file that
+        atomically replaces path. returns (entries, size in bytes, build seconds)"""
+    start = time.perf_counter()
+    built_at = time.time()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    offsets = array.array("Q")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(b"\0" * HEADER.size)
+            position = HEADER.size
+            for short_id, original_url in rows:
+                key, url = short_id.encode("utf-8"), original_url.encode("utf-8")
+                offsets.append(position)
+                f.write(ENTRY_HEADER.pack(len(key), len(url)))
+                f.write(key)
+                f.write(url)
+                position += ENTRY_HEADER.size + len(key) + len(url)
+            offsets.append(position)
+            # 8 byte alignment for the offset array view
+            padding = -position % 8
+            f.write(b"\0" * padding)
+            index_offset = position + padding
+            f.write(offsets.tobytes())
+            build_seconds = time.perf_counter() - start
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(offsets) - 1, index_offset, built_at, build_seconds))
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(offsets) - 1, size, build_seconds
+
+class RedirectSnapshot:
+    """Immutable, sorted short_id -> original_url file that every process maps read-only and binary-searches.
+        rows_fn() must return the current mappings sorted by short_id. the file is rebuilt every `interval` seconds
+        by whichever process gets the build lock first; all processes re-map it when it changes. lookups of IDs that
+        are newer than the snapshot return None so the caller falls back to the database. mappings changed by this
+        process bypass the snapshot until a newer one is loaded, changes made elsewhere show up after the next rebuild"""
+
+    def __init__(self, rows_fn, path, interval=REDIRECT_SNAPSHOT_INTERVAL,
+                 check_interval=REDIRECT_SNAPSHOT_CHECK_INTERVAL):
+        self.rows_fn = rows_fn
+        self.path = path
+        self.interval = interval
+        self.check_interval = check_interval
+        self._file = None
+        self._next_check = 0
+        self._changed = {}
+        self._cleared_at = 0
+        self._lock = threading.Lock()
+        self._builder = ProcessThread(self.__run, "redirect-snapshot-builder")
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.builds = 0
+        self.build_failures = 0
+        self.load_failures = 0
+
+    def get(self, short_id):
+        """Original URL of short_id from the snapshot, or None if the database has to be asked."""
+        self._builder.ensure_started()
+        if time.monotonic() >= self._next_check:
+            self.__reload()
+        snapshot = self._file
+        if snapshot is None:
+            return None
+        if short_id in self._changed or snapshot.built_at <= self._cleared_at:
+            self.bypassed += 1
+            return None
+        original_url = snapshot.get(short_id.encode("utf-8"))
+        if original_url is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return original_url
+
+    def invalidate(self, short_id):
+        """Bypass the snapshot for a mapping this process updated or deleted, until a later snapshot is loaded."""
+        with self._lock:
+            self._changed[short_id] = time.time()
+
+    def invalidate_all(self):
+        """Bypass the snapshot for every mapping until a later snapshot is loaded, e.g. after a bulk delete."""
+        self._cleared_at = time.time()
+
+    def build(self):
+        """Write a new snapshot from rows_fn(), returns (entries, size in bytes, build seconds)."""
+        result = write_snapshot(self.path, self.rows_fn())
+        self.builds += 1
+        self._next_check = 0
+        return result
+
+    def stats(self):
+        snapshot = self._file
+        return {
+            "loaded": snapshot is not None,
+            "entries": snapshot.count if snapshot else 0,
+            "size_bytes": snapshot.size if snapshot else 0,
+            "age_seconds": time.time() - snapshot.built_at if snapshot else None,
+            "build_seconds": snapshot.build_seconds if snapshot else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "builds": self.builds,
+            "build_failures": self.build_failures,
+            "load_failures": self.load_failures,
+        }
+
+    def __reload(self):
+        """Map the snapshot file again if it was replaced since the last check."""
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if self._file is not None and self._file.identity == (stat.st_ino, stat.st_mtime_ns):
+                return
+            try:
+                snapshot = _SnapshotFile(self.path)
+            except (OSError, ValueError) as e:
+                self.load_failures += 1
+                logger.warning("redirect snapshot could not be loaded: %s", e)
+                return
+            self._file = snapshot
+            self._changed = {short_id: changed_at for short_id, changed_at in self._changed.items()
+                             if changed_at >= snapshot.built_at}
+
+    def __run(self):
+        while True:
+            try:
+                self.__build_if_stale()
+            except Exception:
+                self.build_failures += 1
+                logger.exception("redirect snapshot build failed, retrying later")
+            time.sleep(min(self.interval, self.check_interval))
+
+    def __build_if_stale(self):
+        """Rebuild once the file is older than the interval. the lock file keeps the other workers (and pods on
+            the same volume) from building at the same time"""
+        if not self.__stale():
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                # another process may have finished a build while we waited for the lock
+                if self.__stale():
+                    entries, size, seconds = self.build()
+                    logger.info("redirect snapshot built: %d mappings, %d bytes in %.3fs", entries, size, seconds)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __stale(self):
+        try:
+            return time.time() - os.stat(self.path).st_mtime >= self.interval
+        except FileNotFoundError:
+            return True
+
+if __name__ == "__main__":
+    # build a snapshot right away, e.g. before starting pods with REDIRECT_SNAPSHOT_ENABLED=true
+    from url_shortener_service.database import redirect_snapshot
+    entries, size, seconds = redirect_snapshot.build()
+    print(f"{redirect_snapshot.path}: {entries} mappings, {size} bytes, built in {seconds:.3f}s")
@@ -0,0 +1,141 @@
+"""Copies the url_mappings and their click history of an existing database (a plain urls.db or a shard set) into a
+new shard set.
+
+    python -m url_shortener_service.reshard --to 4                  # urls.db -> urls.0-of-4.db ... urls.3-of-4.db
+    python -m url_shortener_service.reshard --from 4 --to 8
+    python -m url_shortener_service.reshard --from 4 --to 1         # back to a single urls.db
+
+Stop the shortener (so no clicks are left in its buffers) before resharding, then start it with DB_SHARDS set to
+the new count. The source files are left untouched; listing cursors handed out before resharding become invalid.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from url_shortener_service.sharding import shard_for, shard_paths
+
+DB_MOUNT_POINT = os.getenv("DB_MOUNT_POINT", "/var/data")
+DB_NAME = os.getenv("DB_NAME_SHORTENER", "urls.db")
+COPY_CHUNK_SIZE = 10000
+SHARDED_TABLES = ("url_mappings", "click_buckets", "click_rollups")
+
+def __schema(conn):
+    """CREATE statements of the sharded tables and their indexes, as stored in the source database."""
+    rows = conn.execute("SELECT sql FROM sqlite_master WHERE tbl_name IN (?, ?, ?) AND type IN ('table', 'index') "
+                        "AND sql IS NOT NULL ORDER BY type DESC", SHARDED_TABLES).fetchall()
+    return [row[0] for row in rows]
+
+def __has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def __rollup_watermarks(sources):
+    """Per granularity, the earliest point up to which all sources were rolled up. the shortener recomputes the
+        coarse buckets from there on, so no source's clicks are left out of them"""
+    watermarks = {}
+    for source in sources:
+        if not __has_table(source, "click_rollups"):
+            continue  # created before click analytics, it has no click buckets either
+        for granularity, rolled_up_to in source.execute("SELECT granularity, rolled_up_to FROM click_rollups"):
+            watermarks[granularity] = min(rolled_up_to, watermarks.get(granularity, rolled_up_to))
+    return watermarks
+
+def __copy_rows(source, targets, select, insert, log, label):
+    """Copy the rows of a query to the target shard of their short ID (first column), returns the number copied."""
+    copied = 0
+    start = time.perf_counter()
+    cursor = source.execute(select)
+    while True:
+        rows = cursor.fetchmany(COPY_CHUNK_SIZE)
+        if not rows:
+            break
+        by_shard = {}
+        for row in rows:
+            by_shard.setdefault(shard_for(row[0], len(targets)), []).append(row)
+        for shard, shard_rows in by_shard.items():
+            targets[shard].executemany(insert, shard_rows)
+        copied += len(rows)
+        log(f"{label}: {copied} rows copied ({copied / (time.perf_counter() - start):.0f}/s)")
+    return copied
+
+def __sequence_value(conn):
+    try:
+        row = conn.execute("SELECT next_value FROM id_sequence WHERE name = 'short_id'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+def reshard(mount_point, db_name, source_shards, target_shards, log=print):
+    """Copy every mapping and its click buckets from the source shard set into a new one, returns the number of
+        mappings copied."""
+    source_paths = shard_paths(mount_point, db_name, source_shards)
+    target_paths = shard_paths(mount_point, db_name, target_shards)
+    missing = [path for path in source_paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"source database missing: {', '.join(missing)}")
+    existing = [path for path in target_paths if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f"target database already exists: {', '.join(existing)}")
+
+    sources = [sqlite3.connect(f"file:{path}?mode=ro", uri=True) for path in source_paths]
+    targets = [sqlite3.connect(path) for path in target_paths]
+    try:
+        schema = __schema(sources[0])
+        next_value = max((value for value in map(__sequence_value, sources) if value is not None), default=0)
+        watermarks = __rollup_watermarks(sources)
+        for shard, target in enumerate(targets):
+            target.execute("PRAGMA journal_mode = WAL")
+            for statement in schema:
+                target.execute(statement)
+            if shard == 0:
+                target.execute("CREATE TABLE id_sequence (name TEXT PRIMARY KEY, next_value INTEGER NOT NULL)")
+                target.execute("INSERT INTO id_sequence (name, next_value) VALUES ('short_id', ?)", (next_value,))
+            if watermarks:
+                target.executemany("INSERT INTO click_rollups (granularity, rolled_up_to) VALUES (?, ?)",
+                                   sorted(watermarks.items()))
+
+        copied = 0
+        for path, source in zip(source_paths, sources):
+            copied += __copy_rows(source, targets,
+                                  "SELECT short_id, original_url, access_count, owner FROM url_mappings ORDER BY id",
+                                  "INSERT INTO url_mappings (short_id, original_url, access_count, owner) VALUES (?, ?, ?, ?)",
+                                  log, os.path.basename(path))
+            if __has_table(source, "click_buckets"):
+                __copy_rows(source, targets, "SELECT short_id, granularity, bucket_start, clicks FROM click_buckets",
+                            "INSERT INTO click_buckets (short_id, granularity, bucket_start, clicks) VALUES (?, ?, ?, ?)",
+                            log, f"{os.path.basename(path)} click buckets")
+
+        for target in targets:
+            target.commit()
+        return copied
+    except BaseException:
+        for target in targets:
+            target.close()
+        for path in target_paths:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        raise
+    finally:
+        for conn in sources + targets:
+            conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="source_shards", type=int, default=1, help="shard count of the existing data")
+    parser.add_argument("--to", dest="target_shards", type=int, required=True, help="new shard count")
+    parser.add_argument("--mount-point", default=DB_MOUNT_POINT, help="directory of the database files")
+    parser.add_argument("--db-name", default=DB_NAME, help="database name the shard files are derived from")
+    args = parser.parse_args()
+    if args.source_shards == args.target_shards or min(args.source_shards, args.target_shards) < 1:
+        parser.error("--from and --to must be different positive shard counts")
+
+    try:
+        copied = reshard(args.mount_point, args.db_name, args.source_shards, args.target_shards)
+    except (FileNotFoundError, FileExistsError) as e:
+        sys.exit(str(e))
+    print(f"{copied} mappings copied into {args.target_shards} shard(s), start the shortener with DB_SHARDS={args.target_shards}")
+
+if __name__ == "__main__":
+    main()
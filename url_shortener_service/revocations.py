@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+import os
+from url_shortener_service.background import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# revocation feed settings, used when tokens are verified locally
+REVOCATION_POLL_INTERVAL = float(os.getenv("REVOCATION_POLL_INTERVAL", 5))  # seconds between feed polls
+REVOCATION_MAX_STALENESS = float(os.getenv("REVOCATION_MAX_STALENESS", 60))  # seconds without a successful poll, 0: no limit
+
+class RevocationSet:
+    """In-memory copy of the auth service's revocation feed, so tokens can be verified without asking it.
+        fetch_fn(since) returns the feed response after version `since` ({"version", "revocations", "more"}).
+        a background thread polls it every poll_interval seconds; entries are dropped locally once they expire,
+        since the tokens they revoke have expired by then. stale() tells whether the last successful poll is
+        longer than max_staleness ago (or there was none yet)"""
+
+    def __init__(self, fetch_fn, poll_interval=REVOCATION_POLL_INTERVAL, max_staleness=REVOCATION_MAX_STALENESS):
+        self.fetch_fn = fetch_fn
+        self.poll_interval = poll_interval
+        self.max_staleness = max_staleness
+        self.version = 0
+        self._jtis = {}
+        self._users = {}
+        self._synced_at = None
+        self._lock = threading.Lock()
+        self._poller = ProcessThread(self.__run, "revocation-poller", on_start=self.__reset)
+        self.syncs = 0
+        self.errors = 0
+
+    def start(self):
+        """Start polling in the background, is_revoked() and fresh() do so on first use."""
+        self._poller.ensure_started()
+
+    def is_revoked(self, claims):
+        """True if the token with these claims was revoked, by its jti or by a revocation of its user's tokens."""
+        self._poller.ensure_started()
+        now = time.time()
+        if self._jtis.get(claims.get("jti"), 0) > now:
+            return True
+        user = self._users.get(claims.get("name"))
+        return user is not None and user[1] > now and (claims.get("iat") or 0) < user[0]
+
+    def stale(self):
+        if self.max_staleness <= 0:
+            return False
+        return self._synced_at is None or time.monotonic() - self._synced_at > self.max_staleness
+
+    def fresh(self):
+        """True if the set is recent enough to rely on, polls right away (e.g. on the first request) if it is not."""
+        self._poller.ensure_started()
+        if self.stale():
+            try:
+                self.sync(if_stale=True)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("revocation feed poll failed: %s", e)
+        return not self.stale()
+
+    def sync(self, if_stale=False):
+        """Apply the revocations published since the last poll. with if_stale, only if the set is stale, e.g.
+            because another thread polled while this one waited for the lock"""
+        with self._lock:
+            if if_stale and not self.stale():
+                return
+            while True:
+                feed = self.fetch_fn(self.version)
+                for revocation in feed["revocations"]:
+                    if "jti" in revocation:
+                        self._jtis[revocation["jti"]] = revocation["expires_at"]
+                    else:
+                        # a later revocation of the same user revokes at least as much
+                        self._users[revocation["user"]] = (revocation["not_before"], revocation["expires_at"])
+                self.version = feed["version"]
+                if not feed["more"]:
+                    break
+            now = time.time()
+            self._jtis = {jti: expires_at for jti, expires_at in self._jtis.items() if expires_at > now}
+            self._users = {user: entry for user, entry in self._users.items() if entry[1] > now}
+            self._synced_at = time.monotonic()
+            self.syncs += 1
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "revoked_tokens": len(self._jtis),
+            "revoked_users": len(self._users),
+            "age_seconds": time.monotonic() - self._synced_at if self._synced_at is not None else None,
+            "syncs": self.syncs,
+            "errors": self.errors,
+        }
+
+    def __reset(self):
+        # a forked process starts over, the parent's copy may be arbitrarily old by the time it is used
+        self.version, self._jtis, self._users, self._synced_at = 0, {}, {}, None
+
+    def __run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                self.errors += 1
+                logger.warning("revocation feed poll failed, retrying later: %s", e)
+            time.sleep(self.poll_interval)
@@ -1,27 +1,64 @@
-from flask import Blueprint, jsonify, request, redirect, url_for
+from flask import Blueprint, jsonify, request, redirect, url_for, abort, Response
 from werkzeug.exceptions import HTTPException
 from url_shortener_service.database import (
     create_url_mapping, get_original_url, update_url_mapping,
-    delete_url_mapping, get_link_stats, get_db_connection_user
+    delete_url_mapping, get_link_stats, url_cache, allocate_short_id,
+    create_url_mappings, list_short_ids, iter_short_id_chunks, delete_all_url_mappings, redirect_snapshot,
+    short_id_filter, get_click_series
 )
-from url_shortener_service.utils import (generate_short_id, regex_validation, check_authentication)
+from url_shortener_service.click_analytics import GRANULARITIES
+from url_shortener_service.utils import (regex_validation, check_authentication, token_cache_stats,
+                                         auth_client, absolute_url)
+from datetime import datetime, timezone
+import itertools
+import hashlib
 import json
 import sqlite3
+import time
+import os
 
 ERROR_MAPPING_EXISTS = "Mapping for the provided URL: {url} already exists"
+ID_MAX_ATTEMPTS = 5
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 10000))
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", 1000))
+STATS_MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", 10000))  # buckets a time series query may span
+STATS_DEFAULT_RANGE = 86400  # seconds before ?to= when ?from= is missing
+JSON_LINES_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/x-jsonlines")
+
+# "json" answers GET /<id> with the mapping as JSON, "http" redirects with REDIRECT_STATUS and a Location header
+# unless the client asks for JSON (Accept: application/json)
+REDIRECT_MODE = os.getenv("REDIRECT_MODE", "json").lower()
+REDIRECT_STATUS = int(os.getenv("REDIRECT_STATUS", 302))  # 301, 302, 303, 307 or 308
+REDIRECT_MAX_AGE = int(os.getenv("REDIRECT_MAX_AGE", 0))  # seconds browsers, proxies and CDNs may reuse the answer
 
 main = Blueprint('main', __name__)
 
+def __wants_json():
+    """In http mode, JSON is returned to clients that prefer it over HTML (browsers and */* get the redirect)."""
+    return request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json"
+
 @main.route('/<string:id>', methods=['GET'])
 def get_url(id):
-    """Redirects to the original URL and updates access count."""
+    """Redirects to the original URL and updates access count. the JSON variant carries an ETag of the mapping and
+       answers If-None-Match with 304"""
     url = get_original_url(id)
 
-    if url:
-        return jsonify({"id": id, "value": url}), 301
-    else:
+    if not url:
         return jsonify({"error": "URL not found"}), 404
 
+    if REDIRECT_MODE == "http" and not __wants_json():
+        response = redirect(absolute_url(url), code=REDIRECT_STATUS)
+    else:
+        response = jsonify({"id": id, "value": url})
+        response.status_code = 301
+        response.set_etag(hashlib.blake2b(f"{id}\0{url}".encode("utf-8"), digest_size=16).hexdigest())
+        if request.if_none_match.contains(response.get_etag()[0]):
+            response = Response(status=304, headers={"ETag": response.headers["ETag"]})
+    response.headers["Cache-Control"] = f"public, max-age={REDIRECT_MAX_AGE}"
+    if REDIRECT_MODE == "http":
+        response.vary.add("Accept")
+    return response
+
 @main.route('/<string:id>', methods=['PUT'])
 def update_url(id):
     """Updates the URL mapping for an existing short ID."""
@@ -60,19 +97,40 @@ def delete_id(id):
 
 @main.route('/', methods=['GET'])
 def get_all_ids():
-    """Retrieves all stored short URLs (IDs only)."""
+    """Retrieves the caller's short URLs (IDs only), all of them for admins.
+       ?limit=&after= returns one page plus the cursor of the next page, otherwise the whole listing is streamed
+       from the database cursor as JSON, or as NDJSON with ?format=ndjson"""
     user_info = check_authentication()
-
-    conn = get_db_connection_user(user_info)
-    cursor = conn.cursor()
-    cursor.execute("SELECT short_id FROM url_mappings")
-    ids = [row["short_id"] for row in cursor.fetchall()]
-    conn.close()
-        
-    if not ids:
+    after = request.args.get("after", 0, type=int)
+    limit = request.args.get("limit", type=int)
+
+    if limit is not None:
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        rows = list_short_ids(user_info, after, limit + 1)
+        if not rows and after == 0:
+            return jsonify({"error": "No URLs found"}), 404
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return jsonify({"ids": [short_id for _, short_id in rows[:limit]], "next": next_cursor}), 200
+
+    chunks = iter_short_id_chunks(user_info, after)
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
         return jsonify({"error": "No URLs found"}), 404  
 
-    return jsonify({"ids": ids}), 200
+    if request.args.get("format") == "ndjson":
+        def generate_ndjson():
+            for chunk in itertools.chain([first_chunk], chunks):
+                yield "".join(json.dumps({"id": short_id}) + "\n" for short_id in chunk)
+        return Response(generate_ndjson(), mimetype="application/x-ndjson"), 200
+
+    def generate_json():
+        yield '{"ids": ['
+        separator = ""
+        for chunk in itertools.chain([first_chunk], chunks):
+            yield separator + ",".join(json.dumps(short_id) for short_id in chunk)
+            separator = ","
+        yield "]}"
+    return Response(generate_json(), mimetype="application/json"), 200
 
 @main.route('/', methods=['POST'])
 def create_id():
@@ -90,41 +148,101 @@ def create_id():
     if regex_validation(url):
         return jsonify({"error": "Invalid URL format"}), 400
 
-    conn = get_db_connection_user(user_info)
-    cursor = conn.cursor()
-
-    # -- REMOVE the logic that returns an existing short_id if URL is already in the database --
-    # i.e., remove any check that returns 301 to the user
-
-    # If a custom short_id is provided, validate and use it.
+    # If a custom short_id is provided, the insert itself fails if it is taken.
     if custom_short_id:
-        cursor.execute("SELECT short_id FROM url_mappings WHERE short_id = ?", (custom_short_id,))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({"error": "Short ID already in use"}), 400
-
         short_id = custom_short_id
+        success = create_url_mapping(short_id, url, user_info)
     else:
-        # Otherwise generate a new unique short ID
-        while True:
-            generated_id = generate_short_id(url)
-            cursor.execute("SELECT short_id FROM url_mappings WHERE short_id = ?", (generated_id,))
-            if not cursor.fetchone():
-                short_id = generated_id
+        # Otherwise allocate a new short ID; only a clash with a custom/legacy ID can make the insert fail
+        for _ in range(ID_MAX_ATTEMPTS):
+            short_id = allocate_short_id(url)
+            success = create_url_mapping(short_id, url, user_info)
+            if success:
                 break
 
-    success = create_url_mapping(short_id, url, user_info)
-    conn.commit()
-    conn.close()
-
     if not success:
         return jsonify({"error": "Short ID already in use"}), 400
 
     return jsonify({"id": short_id, "value": url}), 201
 
+def __read_batch():
+    """Reads the items of a batch request, either a JSON array (or {"urls": [...]}) or JSON Lines, one item per line."""
+    if request.mimetype in JSON_LINES_MIMETYPES:
+        items = []
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            if len(items) >= BATCH_MAX_SIZE:
+                abort(413, description=f"Batch exceeds the maximum of {BATCH_MAX_SIZE} items")
+            items.append(json.loads(line))
+        return items
+
+    input_json = request.get_json(force=True)
+    items = input_json.get("urls") if isinstance(input_json, dict) else input_json
+    if not isinstance(items, list):
+        abort(400, description="Expected a JSON array of URLs")
+    if len(items) > BATCH_MAX_SIZE:
+        abort(413, description=f"Batch exceeds the maximum of {BATCH_MAX_SIZE} items")
+    return items
+
+@main.route('/batch', methods=['POST'])
+def create_ids_batch():
+    """Creates shortened URLs for many URLs at once. Each item is a URL string or an object with 'url'/'value'
+       and an optional custom 'short_id'. Returns a result per item, in input order."""
+    user_info = check_authentication()
+    items = __read_batch()
+
+    results = [None] * len(items)
+    to_create = []
+    positions = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            url, custom_short_id = item, None
+        elif isinstance(item, dict):
+            url, custom_short_id = item.get("url") or item.get("value"), item.get("short_id")
+        else:
+            url, custom_short_id = None, None
+
+        if not url:
+            results[index] = {"index": index, "status": 400, "error": "Missing 'url' or 'value' field"}
+        elif regex_validation(url):
+            results[index] = {"index": index, "status": 400, "error": "Invalid URL format", "value": url}
+        else:
+            to_create.append((custom_short_id, url))
+            positions.append(index)
+
+    short_ids = create_url_mappings(to_create, user_info) if to_create else []
+    for index, short_id, (_, url) in zip(positions, short_ids, to_create):
+        if short_id:
+            results[index] = {"index": index, "status": 201, "id": short_id, "value": url}
+        else:
+            results[index] = {"index": index, "status": 400, "error": "Short ID already in use", "value": url}
+
+    created = len([short_id for short_id in short_ids if short_id])
+    return jsonify({"created": created, "failed": len(items) - created, "results": results}), 200
+
+def __read_time(name, default):
+    """Reads a timestamp argument, epoch seconds or ISO 8601 (UTC unless it carries an offset)."""
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"Invalid '{name}', expected epoch seconds or ISO 8601")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
 @main.route('/stats/<string:id>', methods=['GET'])
 def get_url_stats(id):
-    """Retrieves the number of times the shortened URL was accessed."""
+    """Retrieves the number of times the shortened URL was accessed. with ?from=&to=&granularity= also the clicks
+       per minute, hour or day in that range, the non-empty buckets only"""
     check_authentication()
 
     access_count = get_link_stats(id)
@@ -132,27 +250,49 @@ def get_url_stats(id):
     if access_count is None:
         return jsonify({"error": "Short ID not found"}), 404
 
-    return jsonify({"short_id": id, "clicks": access_count}), 200
+    if not any(name in request.args for name in ("from", "to", "granularity")):
+        return jsonify({"short_id": id, "clicks": access_count}), 200
+
+    granularity = request.args.get("granularity", "hour")
+    if granularity not in GRANULARITIES:
+        abort(400, description=f"Invalid 'granularity', expected one of {', '.join(GRANULARITIES)}")
+    width = GRANULARITIES[granularity]
+    end = __read_time("to", int(time.time()))
+    start = __read_time("from", end - STATS_DEFAULT_RANGE)
+    if start >= end:
+        abort(400, description="'from' must be before 'to'")
+    if (end - start) / width > STATS_MAX_BUCKETS:
+        abort(400, description=f"Range exceeds the maximum of {STATS_MAX_BUCKETS} {granularity} buckets")
+
+    buckets = get_click_series(id, start, end, width)
+    return jsonify({"short_id": id, "clicks": access_count, "granularity": granularity, "from": start, "to": end,
+                    "total": sum(clicks for _, clicks in buckets),
+                    "buckets": [{"start": bucket, "clicks": clicks} for bucket, clicks in buckets]}), 200
 
 @main.route('/', methods=['DELETE'])
 def delete_all():
     """Deletes all shortened URLs."""
     user_info = check_authentication()
 
-    try:
-        conn = get_db_connection_user(user_info)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM url_mappings")
-        deleted = cursor.rowcount
-        conn.commit()
-    finally:
-        conn.close()
+    deleted = delete_all_url_mappings(user_info)
 
     if deleted == 0:
         return jsonify({"error": "No URLs to delete"}), 404 
 
     return "", 404 
 
+@main.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Returns size and hit/miss/eviction counters of the redirect and token caches, the redirect snapshot
+       (size, age, build time) and the negative lookup filter for monitoring."""
+    return jsonify({"redirects": url_cache.stats(), "tokens": token_cache_stats(),
+                    "snapshot": redirect_snapshot.stats(), "short_id_filter": short_id_filter.stats()}), 200
+
+@main.route('/auth/stats', methods=['GET'])
+def get_auth_client_stats():
+    """Returns the auth service circuit breaker state and upstream call latency/error counters."""
+    return jsonify(auth_client.stats()), 200
+
 @main.errorhandler(HTTPException)
 def handle_http_exception(e):
      return jsonify({"error": str(e)}), e.code
@@ -0,0 +1,26 @@
+import hashlib
+import os
+
+def shard_for(short_id, shards):
+    """Shard index of a short ID. a stable hash, so every process (and the reshard tool) routes the same way."""
+    if shards == 1:
+        return 0
+    digest = hashlib.blake2b(short_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+def shard_paths(mount_point, db_name, shards):
+    """Database files of a shard set. a single shard is the plain db_name, K shards are <name>.<i>-of-<K><ext>
+        so a service configured with another shard count never opens files of a different layout"""
+    if shards == 1:
+        return [os.path.join(mount_point, db_name)]
+    stem, ext = os.path.splitext(db_name)
+    return [os.path.join(mount_point, f"{stem}.{i}-of-{shards}{ext}") for i in range(shards)]
+
+def list_key(row_id, shard, shards):
+    """Listing cursor of a row: row ids are per shard, so they are interleaved with the shard index into
+        one ordering over all shards. with a single shard this is the row id"""
+    return row_id * shards + shard
+
+def shard_after(after, shard, shards):
+    """The per-shard row id after which a listing continues for the cursor `after`."""
+    return (after - shard) // shards
@@ -0,0 +1,148 @@
+import threading
+import mmap
+import zlib
+import time
+import sys
+import os
+from collections import OrderedDict
+
+# short_id -> original_url cache settings
+URL_CACHE_MAX_ENTRIES = int(os.getenv("URL_CACHE_MAX_ENTRIES", 10000))  # 0 disables the cache
+URL_CACHE_MAX_BYTES = int(os.getenv("URL_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+URL_CACHE_TTL = float(os.getenv("URL_CACHE_TTL", 30))  # seconds, 0 means entries never expire
+# slots of the invalidation versions shared by the workers of a pre-fork server, 8 bytes each, 0 disables sharing
+URL_CACHE_SHARED_SLOTS = int(os.getenv("URL_CACHE_SHARED_SLOTS", 65536))
+
+# rough per-entry cost of the OrderedDict node and the (value, expiry, size) tuple
+ENTRY_OVERHEAD_BYTES = 150
+
+class SharedVersions:
+    """Versions of hashed key slots plus one generation, in an anonymous shared memory map. a map created before a
+        pre-fork server forks its workers is shared by all of them, so a version one worker changes is seen by all.
+        versions are random, so two workers changing a slot at the same time still both change it"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._map = mmap.mmap(-1, (slots + 1) * 8)
+        self._versions = memoryview(self._map).cast("Q")
+
+    def get(self, key):
+        """(generation, version of key's slot), both change when key's slot or all slots are bumped."""
+        return self._versions[0], self._versions[self.__slot(key)]
+
+    def bump(self, key):
+        self._versions[self.__slot(key)] = self.__random()
+
+    def bump_all(self):
+        self._versions[0] = self.__random()
+
+    def __slot(self, key):
+        return 1 + zlib.crc32(str(key).encode("utf-8")) % self.slots
+
+    @staticmethod
+    def __random():
+        return int.from_bytes(os.urandom(8), "little")
+
+class LRUCache:
+    """Bounded in-memory LRU cache with optional TTL. bounded both by number of entries and by the
+        approximate memory used by keys and values. with shared_slots, invalidate() and clear() also drop the
+        entries cached by the other workers forked from the same process, see SharedVersions"""
+
+    def __init__(self, max_entries=URL_CACHE_MAX_ENTRIES, max_bytes=URL_CACHE_MAX_BYTES, ttl=URL_CACHE_TTL,
+                 shared_slots=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._shared = SharedVersions(shared_slots) if shared_slots > 0 and max_entries > 0 else None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the cached value or None, refreshing the key's recency on a hit."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, _, version = entry
+            if expires_at and expires_at < time.monotonic():
+                self.__remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if self._shared is not None and version != self._shared.get(key):
+                # invalidated by another worker
+                self.__remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def version(self, key):
+        """Shared version of key, to be taken before the value is read from its source and passed to put(), so
+            an invalidation in between is not missed. None without shared_slots"""
+        return self._shared.get(key) if self._shared is not None else None
+
+    def put(self, key, value, version=None):
+        """Store a value, evicting least recently used entries until both limits hold."""
+        if self.max_entries <= 0:
+            return
+        if version is None:
+            version = self.version(key)
+        size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+            self._entries[key] = (value, expires_at, size, version)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self.__remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a key, e.g. after its mapping was updated or deleted."""
+        if self._shared is not None:
+            self._shared.bump(key)
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        if self._shared is not None:
+            self._shared.bump_all()
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Counters and current size for monitoring."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def __remove(self, key):
+        _, _, size, _ = self._entries.pop(key)
+        self._bytes -= size
@@ -1,47 +1,186 @@
 import hashlib
+import hmac
 import string
 import random
 import regex
 import base64
-import requests
 import json
+import time
 import os
 from flask import request, abort, current_app
 from werkzeug.exceptions import HTTPException
+from url_shortener_service.url_cache import LRUCache
+from url_shortener_service.single_flight import SingleFlight
+from url_shortener_service.auth_client import AuthClient, AuthServiceUnavailable
+from url_shortener_service.revocations import RevocationSet
+from url_shortener_service.metrics import registry, stats_collector
 
 BASE62_ALPHABET = string.digits + string.ascii_letters
 
+# token verification settings: "remote" asks the auth service, "local" checks the HS256 signature with the shared secret
+AUTH_VERIFY_MODE = os.getenv("AUTH_VERIFY_MODE", "remote").lower()
+AUTH_REMOTE_FALLBACK = os.getenv("AUTH_REMOTE_FALLBACK", "false").lower() == "true"
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+# verify locally while the auth service is unavailable (only possible if JWT_SECRET_KEY is set), as long as the
+# revocation feed was polled successfully within REVOCATION_MAX_STALENESS seconds
+AUTH_LOCAL_FALLBACK = os.getenv("AUTH_LOCAL_FALLBACK", "false").lower() == "true"
+# batch verification endpoint and revocation feed of the auth service
+TOKENS_VERIFY_PATH = "/tokens/verify"
+REVOCATIONS_PATH = "/tokens/revocations"
+
+# Determine if running in a containerized environment
+is_containerized = os.getenv("DOCKER_ENV") or os.getenv("KUBERNETES_SERVICE_HOST")
+
+# Get auth service host and port dynamically
+AUTH_SERVICE_HOST = os.getenv("AUTH_SERVICE_HOST", "auth-service" if is_containerized else "localhost")
+AUTH_SERVICE_PORT = os.getenv("AUTH_SERVICE_PORT", "8001")
+
+auth_client = AuthClient(f"http://{AUTH_SERVICE_HOST}:{AUTH_SERVICE_PORT}")
+registry.register_collector(auth_client.collect_metrics)
+
+# logouts and password changes, for tokens verified locally
+revocation_set = RevocationSet(lambda since: auth_client.get(REVOCATIONS_PATH, params={"since": since}).json())
+registry.register_collector(stats_collector("token_revocations", "Token revocation feed", revocation_set.stats,
+                                            ("syncs", "errors")))
+
+# cache of remote verification results, keyed by token digest
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", 10000))  # 0 disables the cache
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 30))  # seconds, 0 disables the cache
+
+token_cache = LRUCache(max_entries=TOKEN_CACHE_MAX_ENTRIES if TOKEN_CACHE_TTL > 0 else 0,
+                       max_bytes=TOKEN_CACHE_MAX_ENTRIES * 600, ttl=TOKEN_CACHE_TTL)  # digest + claims
+token_verification_flight = SingleFlight()
+
+# patterns are compiled once at import instead of being looked up in the regex module's cache on every call
+#https://stackoverflow.com/questions/1856785/characters-allowed-in-a-url reference to the /^[A-Za-z0-9\-._~!$&'()*+,;=:@\/?]*$/ , which is a PCRE expression that matches valid, unescaped fragment from RFC 2234
+URL_REGEX = regex.compile(r"^((?:http(s)?):\/\/)?(www\\.)?(?!\\.|\\-|www\\.)([a-zA-Z0-9_.-]+)(\.[A-Za-z]{2,})((\/)[A-Za-z0-9\\-–.__~#!$&'()*+,;=:@\/?]*)?$")
+URL_SCHEME_REGEX = regex.compile(r"^[A-Za-z][A-Za-z0-9+.-]*://")
+JWT_STRING_REGEX = regex.compile("^[A-Za-z0-9_-]{2,}(\\.[A-Za-z0-9_-]{2,}){2}$")
+
 def base62_encode(num):
     """Encodes an integer into a Base62 string."""
     if num == 0:
         return BASE62_ALPHABET[0]
-    
-    encoded = []
-    base = len(BASE62_ALPHABET)  
 
+    alphabet = BASE62_ALPHABET
+    encoded = []
     while num:
-        num, remainder = divmod(num, base)
-        encoded.append(BASE62_ALPHABET[remainder])
-
-    return ''.join(reversed(encoded))
+        num, remainder = divmod(num, 62)
+        encoded.append(alphabet[remainder])
+    encoded.reverse()
+    return ''.join(encoded)
 
 def generate_short_id(url, length=6):
     """Generates a unique short ID for a URL."""
     randomNum = ''.join(random.choices(BASE62_ALPHABET, k=8))
-    hash_digest = hashlib.sha256((url + randomNum).encode()).hexdigest()
-    num = int(hash_digest[:10], 16)  
+    # the first 5 digest bytes, same number as the first 10 hex digits without hex encoding the digest
+    num = int.from_bytes(hashlib.sha256((url + randomNum).encode()).digest()[:5], "big")
     return base62_encode(num)[:length]
 
 def regex_validation(url):
     """Check whether url follows valid structure"""
-    #https://stackoverflow.com/questions/1856785/characters-allowed-in-a-url reference to the /^[A-Za-z0-9\-._~!$&'()*+,;=:@\/?]*$/ , which is a PCRE expression that matches valid, unescaped fragment from RFC 2234
-    url_regex = r"^((?:http(s)?):\/\/)?(www\\.)?(?!\\.|\\-|www\\.)([a-zA-Z0-9_.-]+)(\.[A-Za-z]{2,})((\/)[A-Za-z0-9\\-–.__~#!$&'()*+,;=:@\/?]*)?$"
-    if regex.match(url_regex, url):
+    if URL_REGEX.match(url):
         return 0
     return 1
 
+def absolute_url(url):
+    """url with http:// in front if it has none. URL_REGEX accepts URLs without a scheme, which a browser would
+       resolve as a path on the shortener's host if they were sent as Location as is"""
+    return url if URL_SCHEME_REGEX.match(url) else "http://" + url
+
 def regex_validate_jwt_string(str):
-    return regex.match("^[A-Za-z0-9_-]{2,}(\\.[A-Za-z0-9_-]{2,}){2}$", str)
+    return JWT_STRING_REGEX.match(str)
+
+def b64url_decode(segment):
+    """Decodes an unpadded base64url JWT segment."""
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+def verify_jwt_locally(jwt):
+    """Verifies the HS256 signature of a JWT with the secret shared with the auth service, same construction as
+       auth_service.utils.verify_jwt (HMAC-SHA256 over 'header.payload', base64url without padding), its expiry
+       and the revocations known from the auth service's feed. returns the token's claims, or None if it is invalid"""
+    encoded_header, encoded_payload, encoded_signature = jwt.split(".")
+    if json.loads(b64url_decode(encoded_header)).get("alg") != "HS256":
+        return None
+    signing_input = (encoded_header + "." + encoded_payload).encode("utf-8")
+    signature = hmac.new(JWT_SECRET_KEY.encode("utf-8"), signing_input, hashlib.sha256).digest()
+    expected_signature = base64.urlsafe_b64encode(signature).decode("utf-8").rstrip("=")
+    if not hmac.compare_digest(expected_signature, encoded_signature):
+        return None
+    claims = json.loads(b64url_decode(encoded_payload))
+    expires_at = claims.get("exp")
+    if not isinstance(expires_at, (int, float)) or expires_at <= time.time():
+        return None
+    return None if revocation_set.is_revoked(claims) else claims
+
+def verification_result(result):
+    """Claims of a valid token from one /tokens/verify result, False for an invalid one (cacheable, unlike None)."""
+    return result["claims"] if result["valid"] else False
+
+def verify_jwt_remotely(jwt):
+    """Passes the token to the auth service for verification, returns the claims it verified or False.
+       raises AuthServiceUnavailable if the auth service can't answer"""
+    resp = auth_client.post(TOKENS_VERIFY_PATH, json={"tokens": [jwt]})
+    return verification_result(resp.json()["results"][0]) if resp.status_code == 200 else False
+
+def token_cache_key(jwt):
+    """Key of a token in token_cache, the raw token is never stored."""
+    return hashlib.sha256(jwt.encode("utf-8")).hexdigest()
+
+def verify_jwt_remotely_cached(jwt):
+    """Remote verification with a short-lived result cache. concurrent requests with the same token share one
+       in-flight call to the auth service. returns the claims or False"""
+    key = token_cache_key(jwt)
+    verified = token_cache.get(key)
+    if verified is not None:
+        return verified
+
+    def verify_and_cache():
+        result = verify_jwt_remotely(jwt)
+        token_cache.put(key, result)
+        return result
+    return token_verification_flight.do(key, verify_and_cache)
+
+def token_cache_stats():
+    """Token cache counters plus coalesced waits and upstream calls for monitoring."""
+    stats = token_cache.stats()
+    flight_stats = token_verification_flight.stats()
+    stats["upstream_calls"] = flight_stats["calls"]
+    stats["coalesced_waits"] = flight_stats["coalesced"]
+    stats["in_flight"] = flight_stats["in_flight"]
+    return stats
+
+registry.register_collector(stats_collector("token_cache", "Token verification cache", token_cache_stats,
+                                            ("hits", "misses", "evictions", "expirations", "invalidations",
+                                             "upstream_calls", "coalesced_waits")))
+
+def verify_jwt(jwt):
+    """Verifies a token according to AUTH_VERIFY_MODE and returns its claims, or None if it is invalid. in local mode the auth service is only asked if
+       AUTH_REMOTE_FALLBACK is enabled and the token could not be verified locally (e.g. no secret configured, or
+       no recent copy of the revocation feed; without the fallback that raises AuthServiceUnavailable).
+       in remote mode the token is verified locally while the auth service is unavailable, if AUTH_LOCAL_FALLBACK
+       is enabled, the secret is known and the revocation set is up to date"""
+    if AUTH_VERIFY_MODE == "local":
+        # a token is only accepted locally while the revocation set is up to date
+        if JWT_SECRET_KEY and revocation_set.fresh():
+            claims = verify_jwt_locally(jwt)
+            if claims is not None:
+                return claims
+        elif JWT_SECRET_KEY and not AUTH_REMOTE_FALLBACK:
+            raise AuthServiceUnavailable("token revocation feed is out of date")
+        if not AUTH_REMOTE_FALLBACK:
+            return None
+    local_fallback = AUTH_VERIFY_MODE != "local" and AUTH_LOCAL_FALLBACK and JWT_SECRET_KEY
+    if local_fallback:
+        # keep the revocation set current, so it can be relied on once the auth service goes down
+        revocation_set.start()
+    try:
+        return verify_jwt_remotely_cached(jwt) or None
+    except AuthServiceUnavailable:
+        # without a recent copy of the feed, a logged out token would be accepted again
+        if local_fallback and revocation_set.fresh():
+            return verify_jwt_locally(jwt)
+        raise
 
 def check_authentication():
     """checks & verifies authentication based on the provided access token. on successful verification, returns the user's info  
@@ -51,39 +190,16 @@ def check_authentication():
         jwt = request.headers.get(authHeaderName)
         if not regex_validate_jwt_string(jwt):
             raise Exception("")
-    
-        token_json = {"token": jwt}
-        
- 
-        # Determine if running in a containerized environment
-        is_containerized = os.getenv("DOCKER_ENV") or os.getenv("KUBERNETES_SERVICE_HOST")
-
-        # Get auth service host and port dynamically
-        auth_service_host = os.getenv("AUTH_SERVICE_HOST", "auth-service" if is_containerized else "localhost")
-        auth_service_port = os.getenv("AUTH_SERVICE_PORT", "8001")
-
-        auth_service_url = f"http://{auth_service_host}:{auth_service_port}"
-
-        # Pass token to auth service for verification
-        resp = requests.post(f"{auth_service_url}/users/login",
-                             headers={'Content-Type': 'application/json'},
-                             json=token_json)
-        
-        # if the token is verified by auth. service
-        if resp.status_code==200:
-            # extract and return the user_id from the verified token's payload
-            encodedPayload = jwt.split(".")[1]
-            padding = "".rjust(4-(len(encodedPayload)%4),'=')
-            decodedPayload=base64.urlsafe_b64decode(encodedPayload+padding).decode("utf-8")
-            payload=json.loads(decodedPayload)  
-            return payload
+
+        # the claims of the token verified locally or by the auth. service
+        claims = verify_jwt(jwt)
+        if claims is not None:
+            return claims
         else:
             abort(403, description="authentication failure: access token verification failed")
     except HTTPException:
         raise
+    except AuthServiceUnavailable as e:
+        abort(503, description=f"authentication service unavailable: {e}")
     except Exception as e:
         abort(403, description="missing or bad access token")
-
-    
-    
-